@@ -1,10 +1,13 @@
 import numpy as np
 import os
-from numba import njit
-import matplotlib.pyplot as pl
-from matplotlib import patches
-from scipy.integrate import ode
+from numba import njit, prange, config, set_num_threads
+from scipy.integrate import ode, solve_ivp, BDF
+from scipy import sparse
+from scipy.fft import rfft, rfftfreq
 from scipy.special import erf
+from multiprocessing import get_context
+import signal
+import warnings
 from sys import exit
 
 from hfsbe.utility import evaluate_njit_matrix as ev_mat
@@ -12,6 +15,12 @@ from hfsbe.utility import evaluate_njit_matrix as ev_mat
 import params
 import systems as sys
 from efield import driving_field
+
+# Precision the path solutions are stored and returned in, the propagation itself is always done in complex128
+DTYPE_C = np.complex64 if params.single_precision else np.complex128
+# Tolerances of the adaptive solvers, the defaults of zvode
+RTOL, ATOL = 1e-6, 1e-12
+
 '''
 TO DO:
 UPDATE MATRIX METHOD. NOT COMPATIBLE WITH CODE AS OF NOW. MAGNETIC FIELD.
@@ -99,6 +108,9 @@ def main():
     KK_emission         = params.KK_emission
     normalize_emission  = params.normalize_emission
     normalize_f_valence = params.normalize_f_valence
+    n_proc              = params.n_proc or os.cpu_count()   # Number of processes solving the k-paths in parallel
+    solver_method       = params.solver_method              # ODE solver used for the time propagation
+    batch_paths         = params.batch_paths                # Propagate all paths in one state vector
 
     # USER OUTPUT
     ###############################################################################################
@@ -147,7 +159,11 @@ def main():
         sys.system.plot_bands_3d(kpnts[:, 0], kpnts[:, 1])
         sys.system.plot_bands_contour(kpnts[:, 0], kpnts[:, 1])
     if dipole_plots:
-        Ax, Ay = sys.dipole.evaluate(kpnts[:, 0], kpnts[:, 1])
+        # Same compiled dipole functions as in the time evolution
+        kx_plot = np.ascontiguousarray(kpnts[:, 0], dtype=np.float64)
+        ky_plot = np.ascontiguousarray(kpnts[:, 1], dtype=np.float64)
+        Ax = ev_mat(sys.dipole.Axfjit, kx=kx_plot, ky=ky_plot)
+        Ay = ev_mat(sys.dipole.Ayfjit, kx=kx_plot, ky=ky_plot)
         sys.dipole.plot_dipoles(Ax, Ay)
 
     if store_all_timesteps:
@@ -170,39 +186,52 @@ def main():
                 time_evolution(t0, tf, dt, paths, user_out, E_dir, e_fermi, temperature, dk, 
                                gamma1, gamma2, E0, B0, w, chirp, alpha, phase, do_B_field, gauge, normalize_f_valence, dt_out, BZ_type, Nk1, Nk_in_path, 
                                Bcurv_in_B_dynamics, 'density_matrix_dynamics', 
-                               P_E_dir, P_ortho, J_E_dir, J_ortho, I_exact_E_dir, I_exact_ortho, I_exact_diag_E_dir, I_exact_diag_ortho, I_exact_offd_E_dir, I_exact_offd_ortho, KK_emission)
+                               P_E_dir, P_ortho, J_E_dir, J_ortho, I_exact_E_dir, I_exact_ortho, I_exact_diag_E_dir, I_exact_diag_ortho, I_exact_offd_E_dir, I_exact_offd_ortho, KK_emission,
+                               n_proc, solver_method, batch_paths)
+
+    # Time derivative of the polarization, the output times are equidistant
+    dP_E_dir = diff_uniform(t,P_E_dir)
+    dP_ortho = diff_uniform(t,P_ortho)
+
+    # Gaussian envelope of the pulse, the same for all windowed quantities
+    envelope = Gaussian_envelope(t,alpha)
 
-    # Approximate emission in time
-    I_E_dir, I_ortho = diff(t,P_E_dir)*Gaussian_envelope(t,alpha) + J_E_dir*Gaussian_envelope(t,alpha), \
-                       diff(t,P_ortho)*Gaussian_envelope(t,alpha) + J_ortho*Gaussian_envelope(t,alpha)
+    # Approximate emission in time, the enveloped current is reused for its spectrum
+    J_env_E_dir = J_E_dir*envelope
+    J_env_ortho = J_ortho*envelope
+    I_E_dir, I_ortho = dP_E_dir*envelope + J_env_E_dir, \
+                       dP_ortho*envelope + J_env_ortho
 
-    # Fourier transforms
+    # Fourier transforms, all signals are real so only the non-negative frequencies are computed
     dt_out   = t[1]-t[0]
-    freq     = np.fft.fftshift(np.fft.fftfreq(np.size(t), d=dt_out))
-    Iw_E_dir = np.fft.fftshift(np.fft.fft(I_E_dir, norm='ortho'))
-    Iw_ortho = np.fft.fftshift(np.fft.fft(I_ortho, norm='ortho'))
-    Pw_E_dir = np.fft.fftshift(np.fft.fft(diff(t,P_E_dir), norm='ortho'))
-    Pw_ortho = np.fft.fftshift(np.fft.fft(diff(t,P_ortho), norm='ortho'))
-    Jw_E_dir = np.fft.fftshift(np.fft.fft(J_E_dir*Gaussian_envelope(t,alpha), norm='ortho'))
-    Jw_ortho = np.fft.fftshift(np.fft.fft(J_ortho*Gaussian_envelope(t,alpha), norm='ortho'))
-    Iw_exact_E_dir      = np.fft.fftshift(np.fft.fft(I_exact_E_dir*Gaussian_envelope(t,alpha), norm='ortho'))
-    Iw_exact_ortho      = np.fft.fftshift(np.fft.fft(I_exact_ortho*Gaussian_envelope(t,alpha), norm='ortho'))
-    Iw_exact_diag_E_dir = np.fft.fftshift(np.fft.fft(I_exact_diag_E_dir*Gaussian_envelope(t,alpha), norm='ortho'))
-    Iw_exact_diag_ortho = np.fft.fftshift(np.fft.fft(I_exact_diag_ortho*Gaussian_envelope(t,alpha), norm='ortho'))
-    Iw_exact_offd_E_dir = np.fft.fftshift(np.fft.fft(I_exact_offd_E_dir*Gaussian_envelope(t,alpha), norm='ortho'))
-    Iw_exact_offd_ortho = np.fft.fftshift(np.fft.fft(I_exact_offd_ortho*Gaussian_envelope(t,alpha), norm='ortho'))
-
-    Iw_r = []
+    freq     = rfftfreq(np.size(t), d=dt_out)
+    Iw_E_dir = rfft(I_E_dir, norm='ortho')
+    Iw_ortho = rfft(I_ortho, norm='ortho')
+    Pw_E_dir = rfft(dP_E_dir, norm='ortho')
+    Pw_ortho = rfft(dP_ortho, norm='ortho')
+    Jw_E_dir = rfft(J_env_E_dir, norm='ortho')
+    Jw_ortho = rfft(J_env_ortho, norm='ortho')
+
+    # The exact emission signals are windowed in place in a single array and transformed together,
+    # one signal per row
+    I_exact_env = np.array([I_exact_E_dir, I_exact_ortho, I_exact_diag_E_dir, I_exact_diag_ortho,
+                            I_exact_offd_E_dir, I_exact_offd_ortho])
+    I_exact_env *= envelope
+    Iw_exact_E_dir, Iw_exact_ortho, Iw_exact_diag_E_dir, Iw_exact_diag_ortho, Iw_exact_offd_E_dir, Iw_exact_offd_ortho = \
+        rfft(I_exact_env, axis=1, norm='ortho', workers=-1)
+
+    # Emission projected on all polarization angles at once, one angle per row,
+    # from the already windowed signals
     angles = np.linspace(0,2.0*np.pi,361)
-    for angle in angles:
-       Iw_r.append(np.fft.fftshift(np.fft.fft( Gaussian_envelope(t,alpha) * (I_exact_E_dir*np.cos(angle) + I_exact_ortho*np.sin(-angle)))) )
-    Iw_r = np.array(Iw_r)
+    Ir = I_exact_env[0][np.newaxis,:]*np.cos(angles)[:,np.newaxis] \
+         + I_exact_env[1][np.newaxis,:]*np.sin(-angles)[:,np.newaxis]
+    Iw_r = rfft(Ir, axis=1, workers=-1)
 
     if do_emission_wavep:
-       Iw_wavep_E_dir = np.fft.fftshift(np.fft.fft(I_wavep_E_dir*Gaussian_envelope(t,alpha), norm='ortho'))
-       Iw_wavep_ortho = np.fft.fftshift(np.fft.fft(I_wavep_ortho*Gaussian_envelope(t,alpha), norm='ortho'))
-       Iw_wavep_check_E_dir = np.fft.fftshift(np.fft.fft(I_wavep_check_E_dir*Gaussian_envelope(t,alpha), norm='ortho'))
-       Iw_wavep_check_ortho = np.fft.fftshift(np.fft.fft(I_wavep_check_ortho*Gaussian_envelope(t,alpha), norm='ortho'))
+       Iw_wavep_E_dir = rfft(I_wavep_E_dir*envelope, norm='ortho')
+       Iw_wavep_ortho = rfft(I_wavep_ortho*envelope, norm='ortho')
+       Iw_wavep_check_E_dir = rfft(I_wavep_check_E_dir*envelope, norm='ortho')
+       Iw_wavep_check_ortho = rfft(I_wavep_check_ortho*envelope, norm='ortho')
 
     if BZ_type == '2line':
         # include k-point weights
@@ -255,11 +284,12 @@ def main():
 
     if print_J_P_I_files:  
         J_filename = str('J_Nk1-{}_Nk2-{}_w{:4.2f}_E{:4.2f}_a{:4.2f}_ph{:3.2f}_T2-{:05.2f}').format(Nk1,Nk2,w/THz_conv,E0/E_conv,alpha/fs_conv,phase,T2/fs_conv)
-        np.save(J_filename, [t/fs_conv, J_E_dir, J_ortho, freq/w, Jw_E_dir, Jw_ortho])
+        np.savez_compressed(J_filename, t=t/fs_conv, J_E_dir=J_E_dir, J_ortho=J_ortho, freq=freq/w, Jw_E_dir=Jw_E_dir, Jw_ortho=Jw_ortho)
         P_filename = str('P_Nk1-{}_Nk2-{}_w{:4.2f}_E{:4.2f}_a{:4.2f}_ph{:3.2f}_T2-{:05.2f}').format(Nk1,Nk2,w/THz_conv,E0/E_conv,alpha/fs_conv,phase,T2/fs_conv)
-        np.save(P_filename, [t/fs_conv, P_E_dir, P_ortho, freq/w, Pw_E_dir, Pw_ortho])
+        np.savez_compressed(P_filename, t=t/fs_conv, P_E_dir=P_E_dir, P_ortho=P_ortho, freq=freq/w, Pw_E_dir=Pw_E_dir, Pw_ortho=Pw_ortho)
         I_filename = str('I_Nk1-{}_Nk2-{}_w{:4.2f}_E{:4.2f}_a{:4.2f}_ph{:3.2f}_T2-{:05.2f}').format(Nk1,Nk2,w/THz_conv,E0/E_conv,alpha/fs_conv,phase,T2/fs_conv)
-        np.save(I_filename, [t/fs_conv, I_E_dir, I_ortho, freq/w, np.abs(Int_E_dir), np.abs(Int_ortho), Int_E_dir, Int_ortho])
+        np.savez_compressed(I_filename, t=t/fs_conv, I_E_dir=I_E_dir, I_ortho=I_ortho, freq=freq/w, Iw_E_dir=np.abs(Iw_E_dir), Iw_ortho=np.abs(Iw_ortho),
+                            Int_E_dir=Int_E_dir, Int_ortho=Int_ortho)
 
         J_filename = str('J_KK_Nk1-{}_Nk2-{}_w{:4.2f}_E{:4.2f}_a{:4.2f}_ph{:3.2f}_T2-{:05.2f}').format(Nk1,Nk2,w/THz_conv,E0/E_conv,alpha/fs_conv,phase,T2/fs_conv)
         np.savetxt(J_filename, np.c_[freq/w, np.abs(freq**2*Jw_E_dir**2)/Int_tot_base_freq, np.abs(freq**2*Jw_ortho**2)/Int_tot_base_freq])
@@ -278,6 +308,8 @@ def main():
                                       (np.abs(Int_exact_offd_E_dir)+np.abs(Int_exact_offd_ortho))/Int_tot_base_freq ])
 
     if (not test and user_out):
+        # matplotlib is only imported when plotting, runs without user output do not pay for the import
+        import matplotlib.pyplot as pl
         real_fig, (axE,axA,axP,axPdot,axJ) = pl.subplots(5,1,figsize=(10,10))
         t_lims = (-10*alpha/fs_conv, 10*alpha/fs_conv)
         freq_lims = (0,25)
@@ -295,8 +327,8 @@ def main():
         axP.set_xlabel(r'$t$ in fs')
         axP.set_ylabel(r'$P$ in atomic units $\parallel \mathbf{E}_{in}$ (blue), $\bot \mathbf{E}_{in}$ (orange)')
         axPdot.set_xlim(t_lims)
-        axPdot.plot(t/fs_conv,diff(t,P_E_dir))
-        axPdot.plot(t/fs_conv,diff(t,P_ortho))
+        axPdot.plot(t/fs_conv,dP_E_dir)
+        axPdot.plot(t/fs_conv,dP_ortho)
         axPdot.set_xlabel(r'$t$ in fs')
         axPdot.set_ylabel(r'$\dot P$ in atomic units $\parallel \mathbf{E}_{in}$ (blue), $\bot \mathbf{E}_{in}$ (orange)')
         axJ.set_xlim(t_lims)
@@ -525,7 +557,8 @@ def main():
 def time_evolution(t0, tf, dt, paths, user_out, E_dir, e_fermi, temperature, dk, gamma1, gamma2, 
                    E0, B0, w, chirp, alpha, phase, do_B_field, gauge, normalize_f_valence, dt_out, BZ_type, Nk1, Nk_in_path, Bcurv_in_B_dynamics, 
                    dynamics_type, 
-                   P_E_dir, P_ortho, J_E_dir, J_ortho, I_exact_E_dir, I_exact_ortho, I_exact_diag_E_dir, I_exact_diag_ortho, I_exact_offd_E_dir, I_exact_offd_ortho, KK_emission):
+                   P_E_dir, P_ortho, J_E_dir, J_ortho, I_exact_E_dir, I_exact_ortho, I_exact_diag_E_dir, I_exact_diag_ortho, I_exact_offd_E_dir, I_exact_offd_ortho, KK_emission,
+                   n_proc, solver_method, batch_paths):
 
     if dynamics_type == 'density_matrix_dynamics' and user_out:
        print("Enter density matrix dynamics.")
@@ -535,117 +568,84 @@ def time_evolution(t0, tf, dt, paths, user_out, E_dir, e_fermi, temperature, dk,
            print("Wavefunction dynamics only implemented for velocity gauge. Script abords.")
            exit("")
 
-    # Solution containers
-    t = []
-    solution = []
-    fermi_function = []
-
-    # Number of integration steps, time array construction flag
+    # Number of integration steps
     Nt = int((tf-t0)/dt)
-    t_constructed = False
 
-    # Initialize the ode solver
-    solver = ode(f, jac=None).set_integrator('zvode', method='bdf', max_step=dt)
+    # Evaluate the dipoles and band energies of all k-points of all paths in a single call each,
+    # the per path values are slices of these arrays since all paths have the same number of k-points
+    Nk_path = np.size(paths, 1)
+    kx_all = np.ascontiguousarray(np.reshape(paths, (-1, 2))[:, 0], dtype=np.float64)
+    ky_all = np.ascontiguousarray(np.reshape(paths, (-1, 2))[:, 1], dtype=np.float64)
+    di_x_all = ev_mat(sys.dipole.Axfjit, kx=kx_all, ky=ky_all)
+    di_y_all = ev_mat(sys.dipole.Ayfjit, kx=kx_all, ky=ky_all)
+    bandstruct_all = sys.system.evaluate_energy(kx_all, ky_all)
+
+    def path_evaluations(i_path):
+        k_slice = slice(i_path*Nk_path, (i_path+1)*Nk_path)
+        return di_x_all[:, :, k_slice], di_y_all[:, :, k_slice], [band[k_slice] for band in bandstruct_all]
+
+    # Arguments passed to the path solver besides the path and its evaluations
+    path_args = (t0, dt, Nt, dt_out, E_dir, e_fermi, temperature, dk, gamma1, gamma2, E0, B0, w, chirp, alpha, phase,
+                 do_B_field, gauge, Bcurv_in_B_dynamics, dynamics_type, user_out, solver_method)
 
     # SOLVING
     ###########################################################################
-    # Iterate through each path in the Brillouin zone
-    path_num = 1
-    for path in paths:
-        if user_out:
-            print('path: ' + str(path_num))
-
-        # Solution container for the current path
-        path_solution = []
-        path_fermi_function = []
-
-        # Retrieve the set of k-points for the current path
-        kx_in_path = path[:, 0]
-        ky_in_path = path[:, 1]
-
-        # Calculate the dipole components along the path
-        di_x, di_y = sys.dipole.evaluate(kx_in_path, ky_in_path)
-
-        # Calculate the dot products E_dir.d_nm(k).
-        # To be multiplied by E-field magnitude later.
-        # A[0,1,:] means 0-1 offdiagonal element
-        dipole_in_path = (E_dir[0]*di_x[0, 1, :] + E_dir[1]*di_y[0, 1, :])
-        A_in_path = E_dir[0]*di_x[0, 0, :] + E_dir[1]*di_y[0, 0, :] \
-            - (E_dir[0]*di_x[1, 1, :] + E_dir[1]*di_y[1, 1, :])
-        Avv_in_path = E_dir[0]*di_x[0, 0, :] + E_dir[1]*di_y[0, 0, :]
-        Acc_in_path = E_dir[0]*di_x[1, 1, :] + E_dir[1]*di_y[1, 1, :]
-
-        # in bite.evaluate, there is also an interpolation done if b1, b2
-        # are provided and a cutoff radius
-        bandstruct = sys.system.evaluate_energy(kx_in_path, ky_in_path)
-        ecv_in_path = bandstruct[1] - bandstruct[0]
-        ev_in_path = -ecv_in_path/2
-        ec_in_path = ecv_in_path/2
-
-        ec = bandstruct[1]
-
-        # Initialize the values of of each k point vector
-        # (rho_nn(k), rho_nm(k), rho_mn(k), rho_mm(k))
-        y0 = []
-        for i_k, k in enumerate(path):
-            initial_condition(y0,e_fermi,temperature,bandstruct[1],i_k, dynamics_type)
-
-        # append the A-field
-        y0.append(0.0)
-
-        y0_np = np.array(y0)
-
-        # Set the initual values and function parameters for the current kpath
-        solver.set_initial_value(y0, t0).set_f_params(path, dk, gamma1, gamma2, E0, B0, w, chirp, alpha, phase, do_B_field, 
-                                                      ecv_in_path, ev_in_path, ec_in_path, 
-                                                      dipole_in_path, A_in_path, Avv_in_path, Acc_in_path, 
-                                                      gauge, kx_in_path, ky_in_path, E_dir, y0_np, Bcurv_in_B_dynamics, 
-                                                      dynamics_type)
-
-        # Propagate through time
-        ti = 0
-        while solver.successful() and ti < Nt:
-
-            # User output of integration progress
-            if (ti % 1000 == 0 and user_out):
-                print('{:5.2f}%'.format(ti/Nt*100))
-
-            # Integrate one integration time step
-            solver.integrate(solver.t + dt)
-
-            # Save solution each output step
-            if ti % dt_out == 0:
-                path_solution.append(solver.y)
-                if dynamics_type == 'wavefunction_dynamics':
-                    path_fermi_function.append( 1/(np.exp((ec[:]-e_fermi)/temperature)+1) )
-
-                # Construct time array only once
-                if not t_constructed:
-                    t.append(solver.t)
-
-            # Increment time counter
-            ti += 1
-
-        # Append path solutions to the total solution arrays
-        solution.append(np.array(path_solution)[:, 0:-1])
-        if dynamics_type == 'wavefunction_dynamics':
-           fermi_function.append(np.array(path_fermi_function)[:, :])
+    # Iterate through each path in the Brillouin zone. The paths are independent of each other,
+    # so they are distributed over n_proc worker processes if requested.
+    if batch_paths:
+        # All paths are propagated at once, the k-points of all paths follow each other in the state
+        # vector and the solution is split up into the single paths afterwards
+        n_paths = np.size(paths, 0)
+        batch_t, batch_solution, batch_fermi_function, _, _ = \
+            solve_path(paths, 'all', di_x_all, di_y_all, bandstruct_all, *path_args)
+        n_out = np.size(batch_solution, 0)
+        k_solution = batch_solution[:, 0:-1].reshape(n_out, n_paths, 8*Nk_path)
+        k_fermi_function = batch_fermi_function.reshape(np.size(batch_fermi_function, 0), n_paths, Nk_path)
+        results = []
+        for i_path in range(n_paths):
+            # Each path gets the shared A-field as its last entry again
+            path_solution = np.concatenate((k_solution[:, i_path], batch_solution[:, -1:]), axis=1)
+            results.append((batch_t, path_solution, k_fermi_function[:, i_path]) + path_evaluations(i_path)[:2])
+    elif n_proc > 1:
+        # The threads of the parallel right hand side are shared out between the workers. The workers
+        # are spawned, a fork of the threaded parent aborts with OpenMP and hangs with TBB as threading layer
+        n_threads = max(1, config.NUMBA_NUM_THREADS//n_proc)
+        pool = get_context('spawn').Pool(processes=n_proc, initializer=init_worker, initargs=(n_threads,))
+        try:
+            jobs = []
+            path_num = 1
+            for path in paths:
+                jobs.append(pool.apply_async(solve_path, (path, path_num) + path_evaluations(path_num-1) + path_args))
+                path_num += 1
+            pool.close()
+            results = [job.get() for job in jobs]
+            pool.join()
+        except KeyboardInterrupt:
+            pool.terminate()
+            pool.join()
+            raise
+    else:
+        results = []
+        path_num = 1
+        for path in paths:
+            results.append(solve_path(path, path_num, *path_evaluations(path_num-1), *path_args))
+            path_num += 1
 
-        solution = np.array(solution)
+    # The time array is the same for all paths
+    t = results[0][0]
 
-        # Slice solution along each path for easier observable calculation
-        if BZ_type == 'full' or BZ_type == 'full_for_velocity':
-            solution = np.array_split(solution, Nk1, axis=2)
-            if dynamics_type == 'wavefunction_dynamics':
-               fermi_function = np.array_split(fermi_function, Nk1, axis=2)
-        elif BZ_type == '2line':
-            solution = np.array_split(solution, Nk_in_path, axis=2)
-            if dynamics_type == 'wavefunction_dynamics':
-               fermi_function = np.array_split(fermi_function, Nk_in_path, axis=2)
+    # Observables are accumulated over the paths in path order
+    path_num = 1
+    for path, (path_t, path_solution, path_fermi_function, di_x, di_y) in zip(paths, results):
 
-        solution = np.array(solution)
+        # Slice the path solution along the path for easier observable calculation, as a view:
+        # first index is the k-point in the path, second the path, third the timestep, fourth the component
+        n_out = np.size(path_solution, 0)
+        solution = path_solution[:, 0:-1].reshape(n_out, Nk_path, 8).transpose(1, 0, 2)[:, np.newaxis]
+        if dynamics_type == 'wavefunction_dynamics':
+           fermi_function = path_fermi_function.T[:, np.newaxis, :, np.newaxis]
 
-        A_field  = np.array(path_solution)[:, -1]
+        A_field  = path_solution[:, -1]
 
         # COMPUTE OBSERVABLES
         ###########################################################################
@@ -672,42 +672,222 @@ def time_evolution(t0, tf, dt, paths, user_out, E_dir, e_fermi, temperature, dk,
            I_exact_E_dir, I_exact_ortho, I_exact_diag_E_dir, I_exact_diag_ortho, I_exact_offd_E_dir, I_exact_offd_ortho, P_E_dir, P_ortho, J_E_dir, J_ortho = \
                                           emission_exact(path, solution, E_dir, A_field, gauge, normalize_f_valence, path_num, 
                                                          I_exact_E_dir, I_exact_ortho, I_exact_diag_E_dir, I_exact_diag_ortho, I_exact_offd_E_dir, I_exact_offd_ortho, 
-                                                         P_E_dir, P_ortho, J_E_dir, J_ortho, KK_emission) 
+                                                         P_E_dir, P_ortho, J_E_dir, J_ortho, KK_emission, di_x, di_y) 
         # emission with exact formula with semiclassical formula
 #        if do_emission_wavep:
 #           I_wavep_E_dir, I_wavep_ortho             = emission_wavep(paths, solution, wf_solution, E_dir, A_field, fermi_function) 
 #           I_wavep_check_E_dir, I_wavep_check_ortho = check_emission_wavep(paths, solution, wf_solution, E_dir, A_field, fermi_function) 
-    
-        solution = []
 
-        # Flag that time array has been built up
-        t_constructed = True
         path_num += 1
 
-    # Convert solution and time array to numpy arrays
-    t = np.array(t)
-    fermi_function = np.array(fermi_function)
+    # The observables are accumulated path by path above, the path solutions are views into the
+    # arrays returned by the path solver and are not gathered into a total solution array
+    return t, A_field, P_E_dir, P_ortho, J_E_dir, J_ortho, I_exact_E_dir, I_exact_ortho, I_exact_diag_E_dir, I_exact_diag_ortho, I_exact_offd_E_dir, I_exact_offd_ortho
 
-    # Convert lists into numpy arrays
-    solution = np.array(solution)
-    # Now the solution array is structred as:
-    # first index is kx-index, second is ky-index,
-    # third is timestep, fourth is f_h, p_he, p_eh, f_e
+#################################################################################################
+# FUNCTIONS
+################################################################################################
+def init_worker(n_threads):
+    '''
+    Worker initializer, Ctrl-C is handled by the main process which terminates the pool.
+    Each worker runs the right hand side on n_threads threads.
+    '''
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    set_num_threads(n_threads)
 
+def solve_path(path, path_num, di_x, di_y, bandstruct, t0, dt, Nt, dt_out, E_dir, e_fermi, temperature, dk, gamma1, gamma2, E0, B0, w, chirp, alpha, phase,
+               do_B_field, gauge, Bcurv_in_B_dynamics, dynamics_type, user_out, solver_method):
+    '''
+    Propagates the density matrix (or wavefunctions) of all k-points in a single path through time.
+    Several paths of shape (n_paths, Nk_path, 2) are propagated together as one state vector,
+    the k-points of all paths then follow each other and share the A-field entry.
+    di_x, di_y and bandstruct are the dipoles and band energies already evaluated on the path(s).
+    Returns the time array, the solution and fermi function at each output step and the path dipoles.
+    '''
+    if user_out:
+        print('path: ' + str(path_num))
+
+    # Retrieve the set of k-points for the current path(s), as contiguous arrays since they are
+    # passed to fnumba
+    Nk_path = np.size(path, -2)
+    path = np.ascontiguousarray(np.reshape(path, (-1, 2)), dtype=np.float64)
+    kx_in_path = np.ascontiguousarray(path[:, 0])
+    ky_in_path = np.ascontiguousarray(path[:, 1])
+
+    # Calculate the dot products E_dir.d_nm(k).
+    # To be multiplied by E-field magnitude later.
+    # A[0,1,:] means 0-1 offdiagonal element
+    # The in-path arrays are forced to contiguous complex arrays so that fnumba is always
+    # compiled for the same C-contiguous types
+    dipole_in_path = np.ascontiguousarray(E_dir[0]*di_x[0, 1, :] + E_dir[1]*di_y[0, 1, :], dtype=np.complex128)
+    A_in_path = np.ascontiguousarray(E_dir[0]*di_x[0, 0, :] + E_dir[1]*di_y[0, 0, :]
+                                     - (E_dir[0]*di_x[1, 1, :] + E_dir[1]*di_y[1, 1, :]), dtype=np.complex128)
+    Avv_in_path = np.ascontiguousarray(E_dir[0]*di_x[0, 0, :] + E_dir[1]*di_y[0, 0, :], dtype=np.complex128)
+    Acc_in_path = np.ascontiguousarray(E_dir[0]*di_x[1, 1, :] + E_dir[1]*di_y[1, 1, :], dtype=np.complex128)
+
+    ecv_in_path = np.ascontiguousarray(bandstruct[1] - bandstruct[0], dtype=np.float64)
+    ev_in_path = -ecv_in_path/2
+    ec_in_path = ecv_in_path/2
+
+    ec = bandstruct[1]
+
+    # Initialize the values of of each k point vector
+    # (rho_nn(k), rho_nm(k), rho_mn(k), rho_mm(k))
+    # and the A-field as last entry
+    y0 = initial_condition(e_fermi,temperature,bandstruct[1],dynamics_type)
+
+    # Real initial values the occupations are damped towards
+    y0_np = y0.real.copy()
+
+    # Solution vector index of the next (m) and previous (n) k-point of each k-point, periodic in k
+    # within each path
+    k_in_path = np.arange(np.size(path, 0))
+    path_start = k_in_path - k_in_path % Nk_path
+    m_idx = 8*(path_start + (k_in_path+1) % Nk_path)
+    n_idx = 8*(path_start + (k_in_path-1) % Nk_path)
+
+    # Function parameters for the current kpath
+    f_params = (path, dk, gamma1, gamma2, E0, B0, w, chirp, alpha, phase, do_B_field,
+                ecv_in_path, ev_in_path, ec_in_path,
+                dipole_in_path, A_in_path, Avv_in_path, Acc_in_path,
+                gauge, kx_in_path, ky_in_path, E_dir, y0_np, Bcurv_in_B_dynamics,
+                dynamics_type, m_idx, n_idx)
+
+    # Number of output steps
+    n_out = np.count_nonzero(np.arange(Nt)%dt_out == 0)
+
+    # The whole time propagation is done in a single compiled call
+    if solver_method == 'rk45':
+        t, path_solution = integrate_path(y0, t0, dt, Nt, dt_out, n_out, f_params, RTOL, ATOL)
+        if dynamics_type == 'wavefunction_dynamics':
+            path_fermi_function = np.tile(1/(np.exp((ec[:]-e_fermi)/temperature)+1), (n_out, 1))
+        else:
+            path_fermi_function = np.empty((0, np.size(ec)))
+        return t, path_solution.astype(DTYPE_C, copy=False), path_fermi_function, di_x, di_y
+
+    # Solution containers for the current path
+    # The output times are fixed by the time grid, the solution is saved after every dt_out'th time step
+    # starting with the first
+    t = t0 + (np.arange(n_out)*dt_out + 1)*dt
+    path_solution = np.empty((n_out, y0.size), dtype=DTYPE_C)
     if dynamics_type == 'wavefunction_dynamics':
-        fermi_function = np.array(fermi_function)
+        path_fermi_function = np.empty((n_out, np.size(ec)))
+    else:
+        path_fermi_function = np.empty((0, np.size(ec)))
+
+    if solver_method == 'bdf_sparse' and (gauge != 'length' or do_B_field
+                                          or dynamics_type != 'density_matrix_dynamics'):
+        warnings.warn("solver_method 'bdf_sparse' is only implemented for density matrix dynamics in the "
+                      "length gauge without B-field, zvode 'bdf' is used instead")
+        solver_method = 'bdf'
+
+    if solver_method == 'bdf_sparse':
+        # The Jacobian is J0 + E(t)*J1 with sparse matrices set up once, so the BDF solver factorizes
+        # it with a sparse LU instead of the dense LU of zvode
+        J0, J1 = jac_sparse_parts(dk, gamma1, gamma2, ecv_in_path, dipole_in_path, A_in_path, m_idx, n_idx)
+        sol = solve_ivp(fnumba, (t0, t[-1]), y0, method=BDF_init, t_eval=t, args=f_params, max_step=dt,
+                        rtol=RTOL, atol=ATOL, jac=lambda t, y, *args: J0 + driving_field(E0, t)*J1)
+
+        # Output steps after a failed integration are left empty, as in the zvode loop
+        path_solution[:sol.y.shape[1]] = sol.y.T
+        return t, path_solution, path_fermi_function, di_x, di_y
+
+    # Initialize the ode solver and set the initual values and function parameters for the current kpath,
+    # the jitted right hand side is called by zvode directly. The Adams methods of zvode are used with
+    # functional iteration, without any Jacobian, for BDF zvode builds the Jacobian from finite
+    # differences of fnumba
+    if solver_method == 'adams':
+        solver = ode(fnumba).set_integrator('zvode', method='adams', with_jacobian=False, max_step=dt, rtol=RTOL, atol=ATOL)
+    else:
+        solver = ode(fnumba, jac=None).set_integrator('zvode', method='bdf', max_step=dt, rtol=RTOL, atol=ATOL)
+    solver.set_initial_value(y0, t0).set_f_params(*f_params)
 
-    # In case of the velocity gauge, we need to shift the time-dependent
-    # k(t)=k_0+e/hbar A(t) to k_0 = k(t) - e/hbar A(t)
-    if gauge == 'velocity' and do_B_field == False and dynamics_type == 'wavefunction_dynamics':
-        solution = shift_solution(solution, A_field, dk, dynamics_type)
-        fermi_function = shift_solution(fermi_function, A_field, dk, dynamics_type)
+    # Propagate through time, zvode is integrated directly from one output time step to the next
+    # and limits its internal step to dt
+    print_stride = max(1, 1000//dt_out)
+    for i_out in range(n_out):
 
-    return t, A_field, P_E_dir, P_ortho, J_E_dir, J_ortho, I_exact_E_dir, I_exact_ortho, I_exact_diag_E_dir, I_exact_diag_ortho, I_exact_offd_E_dir, I_exact_offd_ortho
+        # User output of integration progress
+        if (i_out % print_stride == 0 and user_out):
+            print('{:5.2f}%'.format(i_out*dt_out/Nt*100))
+
+        # Integrate up to and including the next output time step
+        solver.integrate(t[i_out])
+        if not solver.successful():
+            break
+
+        # Save solution
+        path_solution[i_out] = solver.y
+        if dynamics_type == 'wavefunction_dynamics':
+            path_fermi_function[i_out] = 1/(np.exp((ec[:]-e_fermi)/temperature)+1)
+
+    return t, path_solution, path_fermi_function, di_x, di_y
+
+@njit
+def integrate_path(y0, t0, dt, Nt, dt_out, n_out, f_params, rtol, atol):
+    '''
+    Propagates y0 over Nt time steps of length dt with an adaptive Dormand-Prince (RK45)
+    scheme calling fnumba(t, y, *f_params), the step size never exceeds dt. Returns the time
+    array and the solution at each output step, sampled in the same way as the zvode loop in solve_path.
+    '''
+    # Solution containers
+    t_out = np.empty(n_out)
+    y_out = np.empty((n_out, y0.size), dtype=np.complex128)
+
+    t = t0*1.0
+    y = y0.copy()
+    h = dt
+    k1 = fnumba(t, y, *f_params)
+
+    i_out = 0
+    for ti in range(Nt):
+        # End of the current time step on the fixed time grid, so rounding errors do not accumulate
+        t_end = t0 + (ti + 1)*dt
+
+        # Adaptive steps until the end of the current time step is reached
+        while t < t_end:
+            last_step = h >= t_end - t
+            h_step = t_end - t if last_step else h
+
+            k2 = fnumba(t + h_step/5, y + h_step*(k1/5), *f_params)
+            k3 = fnumba(t + 3*h_step/10, y + h_step*(3*k1/40 + 9*k2/40), *f_params)
+            k4 = fnumba(t + 4*h_step/5, y + h_step*(44*k1/45 - 56*k2/15 + 32*k3/9), *f_params)
+            k5 = fnumba(t + 8*h_step/9, y + h_step*(19372*k1/6561 - 25360*k2/2187 + 64448*k3/6561 - 212*k4/729), *f_params)
+            k6 = fnumba(t + h_step, y + h_step*(9017*k1/3168 - 355*k2/33 + 46732*k3/5247 + 49*k4/176 - 5103*k5/18656), *f_params)
+            y_new = y + h_step*(35*k1/384 + 500*k3/1113 + 125*k4/192 - 2187*k5/6784 + 11*k6/84)
+            k7 = fnumba(t + h_step, y_new, *f_params)
+
+            # Difference between the 5th and the embedded 4th order solution
+            err = h_step*(71*k1/57600 - 71*k3/16695 + 71*k4/1920 - 17253*k5/339200 + 22*k6/525 - k7/40)
+            scale = atol + rtol*np.maximum(np.abs(y), np.abs(y_new))
+            err_norm = np.sqrt(np.mean(np.abs(err/scale)**2))
+
+            if err_norm <= 1.0:
+                t = t_end if last_step else t + h_step
+                y = y_new
+                k1 = k7
+                if err_norm > 0.0:
+                    factor = min(5.0, max(0.2, 0.9*err_norm**(-0.2)))
+                else:
+                    factor = 5.0
+                # A step clamped to the end of the time step is usually much shorter than h, so h is
+                # kept for the next time step unless the error of the clamped step asks for a smaller one
+                if last_step and factor >= 1.0:
+                    h = max(h, h_step*factor)
+                else:
+                    h = h_step*factor
+            else:
+                h = h_step*max(0.2, 0.9*err_norm**(-0.2))
+            h = min(h, dt)
+
+        # Save solution each output step
+        if ti%dt_out == 0:
+            t_out[i_out] = t
+            y_out[i_out, :] = y
+            i_out += 1
+
+    return t_out, y_out
 
-#################################################################################################
-# FUNCTIONS
-################################################################################################
 def mesh(params, E_dir):
     Nk_in_path        = params.Nk_in_path                    # Number of kpoints in each of the two paths
     rel_dist_to_Gamma = params.rel_dist_to_Gamma      # relative distance (in units of 2pi/a) of both paths to Gamma
@@ -720,106 +900,82 @@ def mesh(params, E_dir):
 
     vec_k_ortho = 2.0*np.pi/a*rel_dist_to_Gamma*np.array([E_dir[1], -E_dir[0]])
 
-    # Containers for the mesh, and BZ directional paths
-    mesh = []
-    paths = []
-
-    # Create the kpoint mesh and the paths
-#    for path_index in [-1, 1]:
-    for path_index in np.linspace(-num_paths+1,num_paths-1, num = num_paths):
-
-        print("path_index",path_index)
-
-        # Container for a single path
-        path = []
-        for alpha in alpha_array:
-            # Create a k-point
-            kpoint = path_index*vec_k_ortho + alpha*vec_k_path
-
-            mesh.append(kpoint)
-            path.append(kpoint)
-
-        # Append the a1'th path to the paths array
-        paths.append(path)
+    # Create the kpoint mesh and the paths, the paths are shifted by multiples of vec_k_ortho from Gamma
+    path_index = np.linspace(-num_paths+1,num_paths-1, num = num_paths)
+    paths = path_index[:,np.newaxis,np.newaxis]*vec_k_ortho + alpha_array[np.newaxis,:,np.newaxis]*vec_k_path
+    mesh = paths.reshape(-1,2)
 
     dk = 1.0/Nk_in_path*length_path_in_BZ
 
-    return dk, np.array(mesh), np.array(paths)
-
-
+    return dk, mesh, paths
+
+
+@njit(cache=True)
+def is_in_hex(x,y,a):
+    # Returns true if the point is in the hexagonal BZ.
+    # Checks if the absolute values of x and y components of p are within the first quadrant of the hexagon.
+    x = np.abs(x)
+    y = np.abs(y)
+    return ((y <= 2.0*np.pi/(np.sqrt(3)*a)) and (np.sqrt(3.0)*x + y <= 4*np.pi/(np.sqrt(3)*a)))
+
+@njit(cache=True)
+def reflect_point(x,y,a,b1,b2):
+    if (y > 2*np.pi/(np.sqrt(3)*a)):                     # Crosses top
+        x, y = x - b2[0], y - b2[1]
+    elif (y < -2*np.pi/(np.sqrt(3)*a)):                  # Crosses bottom
+        x, y = x + b2[0], y + b2[1]
+    elif (np.sqrt(3)*x + y > 4*np.pi/(np.sqrt(3)*a)):    # Crosses top-right
+        x, y = x - (b1[0] + b2[0]), y - (b1[1] + b2[1])
+    elif (-np.sqrt(3)*x + y < -4*np.pi/(np.sqrt(3)*a)):  # Crosses bot-right
+        x, y = x - b1[0], y - b1[1]
+    elif (np.sqrt(3)*x + y < -4*np.pi/(np.sqrt(3)*a)):   # Crosses bot-left
+        x, y = x + (b1[0] + b2[0]), y + (b1[1] + b2[1])
+    elif (-np.sqrt(3)*x + y > 4*np.pi/(np.sqrt(3)*a)):   # Crosses top-left
+        x, y = x + b1[0], y + b1[1]
+    return x, y
+
+@njit(cache=True)
 def hex_mesh(Nk1, Nk2, a, b1, b2, align):
-    alpha1 = np.linspace(-0.5 + (1/(2*Nk1)), 0.5 - (1/(2*Nk1)), num=Nk1)
-    alpha2 = np.linspace(-0.5 + (1/(2*Nk2)), 0.5 - (1/(2*Nk2)), num=Nk2)
-
-    def is_in_hex(p, a):
-        # Returns true if the point is in the hexagonal BZ.
-        # Checks if the absolute values of x and y components of p are within the first quadrant of the hexagon.
-        x = np.abs(p[0])
-        y = np.abs(p[1])
-        return ((y <= 2.0*np.pi/(np.sqrt(3)*a)) and (np.sqrt(3.0)*x + y <= 4*np.pi/(np.sqrt(3)*a)))
-
-    def reflect_point(p, a, b1, b2):
-        x = p[0]
-        y = p[1]
-        if (y > 2*np.pi/(np.sqrt(3)*a)):                     # Crosses top
-            p -= b2
-        elif (y < -2*np.pi/(np.sqrt(3)*a)):                  # Crosses bottom
-            p += b2
-        elif (np.sqrt(3)*x + y > 4*np.pi/(np.sqrt(3)*a)):    # Crosses top-right
-            p -= b1 + b2
-        elif (-np.sqrt(3)*x + y < -4*np.pi/(np.sqrt(3)*a)):  # Crosses bot-right
-            p -= b1
-        elif (np.sqrt(3)*x + y < -4*np.pi/(np.sqrt(3)*a)):   # Crosses bot-left
-            p += b1 + b2
-        elif (-np.sqrt(3)*x + y > 4*np.pi/(np.sqrt(3)*a)):   # Crosses top-left
-            p += b1
-        return p
-
-    # Containers for the mesh, and BZ directional paths
-    mesh = []
-    paths = []
+    alpha1 = np.linspace(-0.5 + (1/(2*Nk1)), 0.5 - (1/(2*Nk1)), Nk1)
+    alpha2 = np.linspace(-0.5 + (1/(2*Nk2)), 0.5 - (1/(2*Nk2)), Nk2)
+
+    # Containers for the BZ directional paths, the mesh is the same set of points
+    paths = np.empty((Nk2, Nk1, 2))
 
     # Create the Monkhorst-Pack mesh
     if align == 'M':
-        for a2 in alpha2:
-            # Container for a single gamma-M path
-            path_M = []
-            for a1 in alpha1:
+        for i2 in range(Nk2):
+            for i1 in range(Nk1):
                 # Create a k-point
-                kpoint = a1*b1 + a2*b2
-                # If the current point is in the BZ, append it to the mesh and path_M
-                if (is_in_hex(kpoint,a)):
-                    mesh.append(kpoint)
-                    path_M.append(kpoint)
-                # If the current point is NOT in the BZ, reflect is along the appropriate axis to get it in the BZ, then append.
-                else:
-                    while (is_in_hex(kpoint,a) != True):
-                        kpoint = reflect_point(kpoint,a,b1,b2)
-                    mesh.append(kpoint)
-                    path_M.append(kpoint)
-            # Append the a1'th path to the paths array
-            paths.append(path_M)
+                kx = alpha1[i1]*b1[0] + alpha2[i2]*b2[0]
+                ky = alpha1[i1]*b1[1] + alpha2[i2]*b2[1]
+                # If the current point is NOT in the BZ, reflect is along the appropriate axis to get it in the BZ.
+                while not is_in_hex(kx,ky,a):
+                    kx, ky = reflect_point(kx,ky,a,b1,b2)
+                paths[i2,i1,0] = kx
+                paths[i2,i1,1] = ky
 
     elif align == 'K':
-        b_a1 = 8*np.pi/(a*3)*np.array([1,0])
-        b_a2 = 4*np.pi/(a*3)*np.array([1,np.sqrt(3)])
+        b_a1 = 8*np.pi/(a*3)*np.array([1.0,0.0])
+        b_a2 = 4*np.pi/(a*3)*np.array([1.0,np.sqrt(3)])
+        shift = 2*np.pi/(a)*np.array([1.0,1/np.sqrt(3)])
         # Extend over half of the b2 direction and 1.5x the b1 direction (extending into the 2nd BZ to get correct boundary conditions)
-        alpha1 = np.linspace(-0.5 + (1/(2*Nk1)), 1.0 - (1/(2*Nk1)), num = Nk1)
-        alpha2 = np.linspace(0, 0.5 - (1/(2*Nk2)), num = Nk2)
-        for a2 in alpha2:
-            path_K = []
-            for a1 in alpha1:
-                kpoint = a1*b_a1 + a2*b_a2
-                if is_in_hex(kpoint,a):
-                    mesh.append(kpoint)
-                    path_K.append(kpoint)
-                else:
-                    kpoint -= 2*np.pi/(a)*np.array([1,1/np.sqrt(3)])
-                    mesh.append(kpoint)
-                    path_K.append(kpoint)
-            paths.append(path_K)
+        alpha1 = np.linspace(-0.5 + (1/(2*Nk1)), 1.0 - (1/(2*Nk1)), Nk1)
+        alpha2 = np.linspace(0, 0.5 - (1/(2*Nk2)), Nk2)
+        for i2 in range(Nk2):
+            for i1 in range(Nk1):
+                kx = alpha1[i1]*b_a1[0] + alpha2[i2]*b_a2[0]
+                ky = alpha1[i1]*b_a1[1] + alpha2[i2]*b_a2[1]
+                if not is_in_hex(kx,ky,a):
+                    kx -= shift[0]
+                    ky -= shift[1]
+                paths[i2,i1,0] = kx
+                paths[i2,i1,1] = ky
 
-    return np.array(mesh), np.array(paths)
+    else:
+        raise ValueError("The E-field alignment has to be 'M' or 'K'")
+
+    return paths.reshape(Nk1*Nk2, 2), paths
 
 # @njit
 # def driving_field(E0, w, t, chirp, alpha, phase):
@@ -840,18 +996,22 @@ def rabi(E0, t, dipole):
     return dipole*driving_field(E0, t)
 
 
-def diff(x, y):
+def diff_uniform(x, y):
     '''
-    Takes the derivative of y w.r.t. x
+    Takes the derivative of y w.r.t. x on an equidistant grid x
     '''
     if (len(x) != len(y)):
         raise ValueError('Vectors have different lengths')
     elif len(y) == 1:
         return 0
     else:
-        dx = np.gradient(x)
-        dy = np.gradient(y)
-        return dy/dx
+        # Central differences inside, one-sided differences at the boundaries
+        dx = x[1] - x[0]
+        dydx = np.empty_like(y)
+        dydx[1:-1] = (y[2:] - y[:-2])/(2*dx)
+        dydx[0]    = (y[1] - y[0])/dx
+        dydx[-1]   = (y[-1] - y[-2])/dx
+        return dydx
 
 
 def Gaussian_envelope(t, alpha):
@@ -862,10 +1022,53 @@ def Gaussian_envelope(t, alpha):
     return np.exp(-t**2.0/(2.0*1.0*alpha)**2)
 
 
+def exact_emission_matrix_elements(kx, ky, E_dir, E_ort):
+    '''
+    Matrix elements U^+ dh/dk U of the Hamiltonian derivative along E_dir and E_ort
+    at the k-points (kx, ky), the last index is the k-point
+    '''
+    h_deriv_x = ev_mat(sys.h_deriv[0], kx=kx, ky=ky)
+    h_deriv_y = ev_mat(sys.h_deriv[1], kx=kx, ky=ky)
+
+    h_deriv_E_dir = h_deriv_x*E_dir[0] + h_deriv_y*E_dir[1]
+    h_deriv_ortho = h_deriv_x*E_ort[0] + h_deriv_y*E_ort[1]
+
+    U   = sys.wf  (kx=kx, ky=ky)
+    U_h = sys.wf_h(kx=kx, ky=ky)
+
+    return U_h_H_U(np.ascontiguousarray(U_h, dtype=np.complex128), np.ascontiguousarray(h_deriv_E_dir, dtype=np.complex128),
+                   np.ascontiguousarray(h_deriv_ortho, dtype=np.complex128), np.ascontiguousarray(U, dtype=np.complex128))
+
+
+@njit(cache=True, parallel=True)
+def U_h_H_U(U_h, H_E_dir, H_ortho, U):
+    '''
+    Products U_h H U of the 2x2 matrices of each k-point (last index) for both directions,
+    written out explicitly and distributed over the k-points
+    '''
+    Nk = U.shape[2]
+    out_E_dir = np.empty((2, 2, Nk), dtype=np.complex128)
+    out_ortho = np.empty((2, 2, Nk), dtype=np.complex128)
+    for k in prange(Nk):
+        for i in range(2):
+            a0 = U_h[i,0,k]*H_E_dir[0,0,k] + U_h[i,1,k]*H_E_dir[1,0,k]
+            a1 = U_h[i,0,k]*H_E_dir[0,1,k] + U_h[i,1,k]*H_E_dir[1,1,k]
+            b0 = U_h[i,0,k]*H_ortho[0,0,k] + U_h[i,1,k]*H_ortho[1,0,k]
+            b1 = U_h[i,0,k]*H_ortho[0,1,k] + U_h[i,1,k]*H_ortho[1,1,k]
+            for m in range(2):
+                out_E_dir[i,m,k] = a0*U[0,m,k] + a1*U[1,m,k]
+                out_ortho[i,m,k] = b0*U[0,m,k] + b1*U[1,m,k]
+    return out_E_dir, out_ortho
+
+
 def emission_exact(path, solution, E_dir, A_field, gauge, normalize_f_valence, path_num, I_E_dir, I_ortho, I_exact_diag_E_dir, I_exact_diag_ortho, I_exact_offd_E_dir, I_exact_offd_ortho, 
-                   P_E_dir, P_ortho, J_E_dir, J_ortho, KK_emission):
+                   P_E_dir, P_ortho, J_E_dir, J_ortho, KK_emission, di_x, di_y):
                                                                                                                            
     E_ort = np.array([E_dir[1], -E_dir[0]])                                                                                
+
+    # Dot product d.E of the dipoles in path (already evaluated in time_evolution)
+    d_E_dir = di_x[0, 1, :]*E_dir[0] + di_y[0, 1, :]*E_dir[1]
+    d_ortho = di_x[0, 1, :]*E_ort[0] + di_y[0, 1, :]*E_ort[1]
                                                                                                                            
     n_time_steps = np.size(solution[0,0,:,0])                                                                              
 
@@ -874,87 +1077,77 @@ def emission_exact(path, solution, E_dir, A_field, gauge, normalize_f_valence, p
     else:
         subtract_from_f_v = 0
 
-    for i_time in range(n_time_steps):                                                                                     
-                                                                                                                           
-        path = np.array(path)                                                                                              
-        kx_in_path = path[:, 0]                                                                                            
-        ky_in_path = path[:, 1]                                                                                            
-                                                                                                                           
-        if gauge == 'length':                                                                                              
-                                                                                                                           
-           kx_in_path_backshift = kx_in_path                                                                               
-           ky_in_path_backshift = ky_in_path                                                                               
-                                                                                                                           
-        elif gauge == 'velocity':                                                                                          
-                                                                                                                           
-           kx_in_path_backshift = kx_in_path + A_field[i_time]*E_dir[0]                                                    
-           ky_in_path_backshift = ky_in_path + A_field[i_time]*E_dir[1]                                                    
-                                                                                                                           
-        # EXACT EMISSION                                                                                                   
-                                                                                                                           
-        h_deriv_x = ev_mat(sys.h_deriv[0], kx=kx_in_path_backshift, ky=ky_in_path_backshift)                               
-        h_deriv_y = ev_mat(sys.h_deriv[1], kx=kx_in_path_backshift, ky=ky_in_path_backshift)                               
-                                                                                                                           
-        h_deriv_E_dir = h_deriv_x*E_dir[0] + h_deriv_y*E_dir[1]                                                            
-        h_deriv_ortho = h_deriv_x*E_ort[0] + h_deriv_y*E_ort[1]                                                            
-                                                                                                                           
-        U   = sys.wf  (kx=kx_in_path_backshift, ky=ky_in_path_backshift)                                                   
-        U_h = sys.wf_h(kx=kx_in_path_backshift, ky=ky_in_path_backshift)                                                  
-                                                                                                                           
-        for i_k in range(np.size(kx_in_path)):
-
-            U_h_H_U_E_dir = np.matmul(U_h[:,:,i_k], np.matmul(h_deriv_E_dir[:,:,i_k], U[:,:,i_k]))
-            U_h_H_U_ortho = np.matmul(U_h[:,:,i_k], np.matmul(h_deriv_ortho[:,:,i_k], U[:,:,i_k]))
+    kx_in_path = path[:, 0]
+    ky_in_path = path[:, 1]
 
-            I_E_dir[i_time] += np.real(U_h_H_U_E_dir[0,0])*(np.real(solution[i_k, 0, i_time, 0]) - subtract_from_f_v)
-            I_E_dir[i_time] += np.real(U_h_H_U_E_dir[1,1])*np.real(solution[i_k, 0, i_time, 3])
-            I_E_dir[i_time] += 2*np.real(U_h_H_U_E_dir[0,1]*solution[i_k, 0, i_time, 2])
-            I_exact_diag_E_dir[i_time] += np.real(U_h_H_U_E_dir[0,0])*(np.real(solution[i_k, 0, i_time, 0]) - subtract_from_f_v)
-            I_exact_diag_E_dir[i_time] += np.real(U_h_H_U_E_dir[1,1])*np.real(solution[i_k, 0, i_time, 3])
-            I_exact_offd_E_dir[i_time] += 2*np.real(U_h_H_U_E_dir[0,1]*solution[i_k, 0, i_time, 2])
+    # KK emission only with length gauge
+    if KK_emission and gauge == 'velocity':
+        exit("KK emission only implemented with the length gauge")
 
-            I_ortho[i_time] += np.real(U_h_H_U_ortho[0,0])*(np.real(solution[i_k, 0, i_time, 0]) - subtract_from_f_v)
-            I_ortho[i_time] += np.real(U_h_H_U_ortho[1,1])*np.real(solution[i_k, 0, i_time, 3])
-            I_ortho[i_time] += 2*np.real(U_h_H_U_ortho[0,1]*solution[i_k, 0, i_time, 2])
-            I_exact_diag_ortho[i_time] += np.real(U_h_H_U_ortho[0,0])*(np.real(solution[i_k, 0, i_time, 0]) - subtract_from_f_v)
-            I_exact_diag_ortho[i_time] += np.real(U_h_H_U_ortho[1,1])*np.real(solution[i_k, 0, i_time, 3])
-            I_exact_offd_ortho[i_time] += 2*np.real(U_h_H_U_ortho[0,1]*solution[i_k, 0, i_time, 2])
+    # Density matrix of all k-points in the path at all time steps, first index k-point, second time step.
+    # The components are interleaved in the solution, each one is gathered into its own contiguous array
+    # once so that the reductions and matrix products below run with unit stride
+    f_v  = np.real(solution[:, 0, :, 0]) - subtract_from_f_v
+    p_vc = np.ascontiguousarray(solution[:, 0, :, 1])
+    p_cv = np.ascontiguousarray(solution[:, 0, :, 2])
+    f_c  = np.ascontiguousarray(np.real(solution[:, 0, :, 3]))
 
-        if KK_emission:
-
-           # KK emission only with length gauge
-           if gauge == 'velocity': 
-              exit("KK emission only implemented with the length gauge")
-              
-           # INTERBAND POLARIZATION 
-
-           # Evaluate the dipole moments in path
-           di_x, di_y = sys.dipole.evaluate(kx_in_path, ky_in_path)
-       
-           # Append the dot product d.E
-           d_E_dir = di_x[0, 1, :]*E_dir[0] + di_y[0, 1, :]*E_dir[1]
-           d_ortho = di_x[0, 1, :]*E_ort[0] + di_y[0, 1, :]*E_ort[1]
-      
-           for i_k in range(np.size(kx_in_path)):
-
-              P_E_dir[i_time] += 2*np.real(d_E_dir[i_k]*solution[i_k, 0, i_time, 1])
-              P_ortho[i_time] += 2*np.real(d_ortho[i_k]*solution[i_k, 0, i_time, 1])
-
-           # INTRABAND CURRENT 
-           evdx = sys.system.ederivfjit[0](kx=kx_in_path, ky=ky_in_path)
-           evdy = sys.system.ederivfjit[1](kx=kx_in_path, ky=ky_in_path)
-           ecdx = sys.system.ederivfjit[2](kx=kx_in_path, ky=ky_in_path)
-           ecdy = sys.system.ederivfjit[3](kx=kx_in_path, ky=ky_in_path)
-           
-           # 0: v, x 1: v,y 2: c, x 3: c, y
-           jc_E_dir = ecdx*E_dir[0] + ecdy*E_dir[1]
-           jc_ortho = ecdx*E_ort[0] + ecdy*E_ort[1]
-           jv_E_dir = evdx*E_dir[0] + evdy*E_dir[1]
-           jv_ortho = evdx*E_ort[0] + evdy*E_ort[1]
-           
-           for i_k in range(np.size(kx_in_path)):
-              J_E_dir[i_time] += np.real(jc_E_dir[i_k]*solution[i_k, 0, i_time, 3] + jv_E_dir[i_k]*(solution[i_k, 0, i_time, 0] - subtract_from_f_v))
-              J_ortho[i_time] += np.real(jc_ortho[i_k]*solution[i_k, 0, i_time, 3] + jv_ortho[i_k]*(solution[i_k, 0, i_time, 0] - subtract_from_f_v))
+    # U^+ dh/dk U of all k-points in the path, the third index is the k-point and the last the time step.
+    # In the length gauge the k-points do not move, so it is evaluated once and broadcast over all time steps
+    if gauge == 'length':
+        U_h_H_U_E_dir, U_h_H_U_ortho = exact_emission_matrix_elements(kx_in_path, ky_in_path, E_dir, E_ort)
+        U_h_H_U_E_dir = U_h_H_U_E_dir[..., np.newaxis]
+        U_h_H_U_ortho = U_h_H_U_ortho[..., np.newaxis]
+    elif gauge == 'velocity':
+        # The back-shifted k-points of all time steps are evaluated together, in blocks of time steps
+        # with about 2**20 k-points each to bound the memory of the intermediate matrices
+        Nk_path = np.size(kx_in_path)
+        U_h_H_U_E_dir = np.empty((2, 2, Nk_path, n_time_steps), dtype=np.complex128)
+        U_h_H_U_ortho = np.empty((2, 2, Nk_path, n_time_steps), dtype=np.complex128)
+        n_block = max(1, 2**20//Nk_path)
+        for i_start in range(0, n_time_steps, n_block):
+            A_block = A_field[i_start:i_start+n_block]
+            kx_in_path_backshift = (kx_in_path[:, np.newaxis] + A_block*E_dir[0]).ravel()
+            ky_in_path_backshift = (ky_in_path[:, np.newaxis] + A_block*E_dir[1]).ravel()
+            E_dir_block, ortho_block = exact_emission_matrix_elements(kx_in_path_backshift, ky_in_path_backshift, E_dir, E_ort)
+            U_h_H_U_E_dir[..., i_start:i_start+n_block] = E_dir_block.reshape(2, 2, Nk_path, -1)
+            U_h_H_U_ortho[..., i_start:i_start+n_block] = ortho_block.reshape(2, 2, Nk_path, -1)
+
+    # Diagonal (intraband) and offdiagonal (interband) parts of the exact emission of all time steps,
+    # summed over the path
+    I_diag_E_dir = np.sum(np.real(U_h_H_U_E_dir[0,0])*f_v + np.real(U_h_H_U_E_dir[1,1])*f_c, axis=0)
+    I_offd_E_dir = np.sum(2*np.real(U_h_H_U_E_dir[0,1]*p_cv), axis=0)
+    I_diag_ortho = np.sum(np.real(U_h_H_U_ortho[0,0])*f_v + np.real(U_h_H_U_ortho[1,1])*f_c, axis=0)
+    I_offd_ortho = np.sum(2*np.real(U_h_H_U_ortho[0,1]*p_cv), axis=0)
+
+    I_E_dir += I_diag_E_dir + I_offd_E_dir
+    I_exact_diag_E_dir += I_diag_E_dir
+    I_exact_offd_E_dir += I_offd_E_dir
+
+    I_ortho += I_diag_ortho + I_offd_ortho
+    I_exact_diag_ortho += I_diag_ortho
+    I_exact_offd_ortho += I_offd_ortho
+
+    if KK_emission:
+
+       # INTERBAND POLARIZATION 
+       P_E_dir += 2*np.real(d_E_dir @ p_vc)
+       P_ortho += 2*np.real(d_ortho @ p_vc)
+
+       # INTRABAND CURRENT 
+       evdx = sys.system.ederivfjit[0](kx=kx_in_path, ky=ky_in_path)
+       evdy = sys.system.ederivfjit[1](kx=kx_in_path, ky=ky_in_path)
+       ecdx = sys.system.ederivfjit[2](kx=kx_in_path, ky=ky_in_path)
+       ecdy = sys.system.ederivfjit[3](kx=kx_in_path, ky=ky_in_path)
+
+       # 0: v, x 1: v,y 2: c, x 3: c, y
+       jc_E_dir = ecdx*E_dir[0] + ecdy*E_dir[1]
+       jc_ortho = ecdx*E_ort[0] + ecdy*E_ort[1]
+       jv_E_dir = evdx*E_dir[0] + evdy*E_dir[1]
+       jv_ortho = evdx*E_ort[0] + evdy*E_ort[1]
+
+       J_E_dir += np.real(jc_E_dir @ f_c + jv_E_dir @ f_v)
+       J_ortho += np.real(jc_ortho @ f_c + jv_ortho @ f_v)
 
     return I_E_dir, I_ortho, I_exact_diag_E_dir, I_exact_diag_ortho, I_exact_offd_E_dir, I_exact_offd_ortho, P_E_dir, P_ortho, J_E_dir, J_ortho
 
@@ -970,47 +1163,32 @@ def emission_semicl_B_field(path, solution, E_dir, I_exact_E_dir, I_exact_ortho,
 
     n_time_steps = np.size(solution[0,0,:,0])
                                                                                                                            
-    for i_time in range(n_time_steps):
-
-        path = np.array(path)
-        kx_in_path = path[:, 0]
-        ky_in_path = path[:, 1]
-
-        for i_k in range(np.size(kx_in_path)):
-
-            kx_in_path_shifted_v = kx_in_path[i_k] + solution[i_k, 0, i_time, 4]
-            ky_in_path_shifted_v = ky_in_path[i_k] + solution[i_k, 0, i_time, 5]
-            kx_in_path_shifted_c = kx_in_path[i_k] + solution[i_k, 0, i_time, 6]
-            ky_in_path_shifted_c = ky_in_path[i_k] + solution[i_k, 0, i_time, 7]
-
-            U_shift_v   = sys.wf  (kx=kx_in_path_shifted_v, ky=ky_in_path_shifted_v)
-            U_shift_v_h = sys.wf_h(kx=kx_in_path_shifted_v, ky=ky_in_path_shifted_v)
-            U_shift_c   = sys.wf  (kx=kx_in_path_shifted_c, ky=ky_in_path_shifted_c)
-            U_shift_c_h = sys.wf_h(kx=kx_in_path_shifted_c, ky=ky_in_path_shifted_c)
-
-            h_deriv_x_v = ev_mat(sys.h_deriv[0], kx=kx_in_path_shifted_v, ky=ky_in_path_shifted_v)
-            h_deriv_y_v = ev_mat(sys.h_deriv[1], kx=kx_in_path_shifted_v, ky=ky_in_path_shifted_v)
- 
-            h_deriv_E_dir_v = h_deriv_x_v*E_dir[0] + h_deriv_y_v*E_dir[1]
-            h_deriv_ortho_v = h_deriv_x_v*E_ort[0] + h_deriv_y_v*E_ort[1]
-
-            h_deriv_x_c = ev_mat(sys.h_deriv[0], kx=kx_in_path_shifted_c, ky=ky_in_path_shifted_c)
-            h_deriv_y_c = ev_mat(sys.h_deriv[1], kx=kx_in_path_shifted_c, ky=ky_in_path_shifted_c)
- 
-            h_deriv_E_dir_c = h_deriv_x_c*E_dir[0] + h_deriv_y_c*E_dir[1]
-            h_deriv_ortho_c = h_deriv_x_c*E_ort[0] + h_deriv_y_c*E_ort[1]
-
-            U_h_H_U_E_dir_v = np.matmul(U_shift_v_h[:,:], np.matmul(h_deriv_E_dir_v[:,:,0], U_shift_v[:,:]))
-            U_h_H_U_ortho_v = np.matmul(U_shift_v_h[:,:], np.matmul(h_deriv_ortho_v[:,:,0], U_shift_v[:,:]))
-
-            U_h_H_U_E_dir_c = np.matmul(U_shift_c_h[:,:], np.matmul(h_deriv_E_dir_c[:,:,0], U_shift_c[:,:]))
-            U_h_H_U_ortho_c = np.matmul(U_shift_c_h[:,:], np.matmul(h_deriv_ortho_c[:,:,0], U_shift_c[:,:]))
-
-            I_exact_E_dir[i_time] += np.real(U_h_H_U_E_dir_v[0,0])*(np.real(solution[i_k, 0, i_time, 0]) - subtract_from_f_v)
-            I_exact_E_dir[i_time] += np.real(U_h_H_U_E_dir_c[1,1])*np.real(solution[i_k, 0, i_time, 3])
-
-            I_exact_ortho[i_time] += np.real(U_h_H_U_ortho_v[0,0])*(np.real(solution[i_k, 0, i_time, 0]) - subtract_from_f_v)
-            I_exact_ortho[i_time] += np.real(U_h_H_U_ortho_c[1,1])*np.real(solution[i_k, 0, i_time, 3])
+    kx_in_path = path[:, 0]
+    ky_in_path = path[:, 1]
+
+    # Occupations of all k-points in the path at all time steps, first index k-point, second time step
+    f_v = np.real(solution[:, 0, :, 0]) - subtract_from_f_v
+    f_c = np.ascontiguousarray(np.real(solution[:, 0, :, 3]))
+
+    # The valence and conduction k-points are shifted individually by the B-field dynamics, the
+    # matrix elements at the shifted k-points of all time steps are evaluated together, in blocks
+    # of time steps with about 2**20 k-points each to bound the memory of the intermediate matrices
+    Nk_path = np.size(kx_in_path)
+    n_block = max(1, 2**20//Nk_path)
+    for i_start in range(0, n_time_steps, n_block):
+        block = slice(i_start, i_start+n_block)
+        kx_in_path_shifted_v = (kx_in_path[:, np.newaxis] + np.real(solution[:, 0, block, 4])).ravel()
+        ky_in_path_shifted_v = (ky_in_path[:, np.newaxis] + np.real(solution[:, 0, block, 5])).ravel()
+        kx_in_path_shifted_c = (kx_in_path[:, np.newaxis] + np.real(solution[:, 0, block, 6])).ravel()
+        ky_in_path_shifted_c = (ky_in_path[:, np.newaxis] + np.real(solution[:, 0, block, 7])).ravel()
+
+        U_h_H_U_E_dir_v, U_h_H_U_ortho_v = exact_emission_matrix_elements(kx_in_path_shifted_v, ky_in_path_shifted_v, E_dir, E_ort)
+        U_h_H_U_E_dir_c, U_h_H_U_ortho_c = exact_emission_matrix_elements(kx_in_path_shifted_c, ky_in_path_shifted_c, E_dir, E_ort)
+
+        I_exact_E_dir[block] += np.sum(np.real(U_h_H_U_E_dir_v[0,0]).reshape(Nk_path, -1)*f_v[:, block]
+                                       + np.real(U_h_H_U_E_dir_c[1,1]).reshape(Nk_path, -1)*f_c[:, block], axis=0)
+        I_exact_ortho[block] += np.sum(np.real(U_h_H_U_ortho_v[0,0]).reshape(Nk_path, -1)*f_v[:, block]
+                                       + np.real(U_h_H_U_ortho_c[1,1]).reshape(Nk_path, -1)*f_c[:, block], axis=0)
 
     return I_exact_E_dir, I_exact_ortho
 
@@ -1028,7 +1206,6 @@ def check_emission_wavep(paths, solution, wf_solution, E_dir, A_field, fermi_fun
     for i_time in range(n_time_steps):
 
         for i_path, path in enumerate(paths):
-            path = np.array(path)
             kx_in_path = path[:, 0]
             ky_in_path = path[:, 1]
     
@@ -1086,7 +1263,6 @@ def emission_wavep(paths, solution, wf_solution, E_dir, A_field, fermi_function)
     for i_time in range(n_time_steps):
 
         for i_path, path in enumerate(paths):
-            path = np.array(path)
             kx_in_path = path[:, 0]
             ky_in_path = path[:, 1]
     
@@ -1133,30 +1309,26 @@ def get_A_field(E0, w, t, alpha):
     return np.real(-alpha*E0*np.sqrt(np.pi)/2*np.exp(-w_eff**2/4)*(2+erf(t/2/alpha-1j*w_eff/2)-erf(-t/2/alpha-1j*w_eff/2)))
 
 
-def f(t, y, kpath, dk, gamma1, gamma2, E0, B0, w, chirp, alpha, phase, do_B_field, 
-      ecv_in_path, ev_in_path, ec_in_path, dipole_in_path, 
-      A_in_path, Avv_in_path, Acc_in_path, gauge,
-      kx_in_path, ky_in_path, E_dir, y0_np, Bcurv_in_B_dynamics,  
-      dynamics_type):
-    return fnumba(t, y, kpath, dk, gamma1, gamma2, E0, B0, w, chirp, alpha, phase, do_B_field, 
-                  ecv_in_path,  ev_in_path, ec_in_path, dipole_in_path, 
-                  A_in_path, Avv_in_path, Acc_in_path, gauge,
-                  kx_in_path, ky_in_path, E_dir, y0_np, Bcurv_in_B_dynamics,  
-                  dynamics_type)
-
-@njit
+@njit(parallel=True, fastmath=True)
 def fnumba(t, y, kpath, dk, gamma1, gamma2, E0, B0, w, chirp, alpha, phase, do_B_field, 
            ecv_in_path, ev_in_path, ec_in_path, dipole_in_path, 
            A_in_path, Avv_in_path, Acc_in_path, gauge,
            kx_in_path, ky_in_path, E_dir, y0_np, Bcurv_in_B_dynamics, 
-           dynamics_type):
+           dynamics_type, m_idx, n_idx):
 
     # x != y(t+dt)
     x = np.empty(np.shape(y), dtype=np.dtype('complex'))
 
+    # Driving fields at time t, the same for all k-points
+    E_t = driving_field(E0, t)
+    if do_B_field:
+        B_t = driving_field(B0, t)
+    else:
+        B_t = 0.0
+
     # Gradient term coefficient
     if gauge == 'length':
-        D = driving_field(E0, t)/(2*dk)
+        D = E_t/(2*dk)
     elif gauge == 'velocity':
         k_shift = (y[-1]).real
         kx_shift_path = kx_in_path+E_dir[0]*k_shift
@@ -1168,10 +1340,10 @@ def fnumba(t, y, kpath, dk, gamma1, gamma2, E0, B0, w, chirp, alpha, phase, do_B
 #        alpha_y_shifted = ky_shift_path/length_path_in_BZ
 #        ky_shift_path   = ((np.fmod(alpha_y_shifted+0.5, 1))-0.5)*length_path_in_BZ
 
-        ecv_in_path = sys.ecjit(kx=kx_shift_path, ky=ky_shift_path) \
-            - sys.evjit(kx=kx_shift_path, ky=ky_shift_path)
-        ev_in_path = sys.evjit(kx=kx_shift_path, ky=ky_shift_path)    
-        ec_in_path = sys.ecjit(kx=kx_shift_path, ky=ky_shift_path)    
+        # Each band is evaluated once at the shifted k-points, the gap is formed from them
+        ev_in_path = sys.evjit(kx=kx_shift_path, ky=ky_shift_path)
+        ec_in_path = sys.ecjit(kx=kx_shift_path, ky=ky_shift_path)
+        ecv_in_path = ec_in_path - ev_in_path
 
         di_00x = sys.di_00xjit(kx=kx_shift_path, ky=ky_shift_path)
         di_01x = sys.di_01xjit(kx=kx_shift_path, ky=ky_shift_path)
@@ -1187,22 +1359,23 @@ def fnumba(t, y, kpath, dk, gamma1, gamma2, E0, B0, w, chirp, alpha, phase, do_B
         Acc_in_path = E_dir[0]*di_11x + E_dir[1]*di_11y
         D = 0
 
-    # Update the solution vector
+    # Update the solution vector, each k-point only writes its own components so the k-points are
+    # distributed over the threads
+    # Rabi frequencies of all k-points: w_R = d_12(k).E(t) and w_R = (d_11(k) - d_22(k))*E(t),
+    # one vector multiply each instead of a field evaluation per k-point
+    wr_in_path        = dipole_in_path*E_t
+    wr_d_diag_in_path = A_in_path*E_t
+    wr_d_vv_in_path   = Avv_in_path*E_t
+    wr_d_cc_in_path   = Acc_in_path*E_t
+
     Nk_path = kpath.shape[0]
-    for k in range(Nk_path):
+    for k in prange(Nk_path):
 
         num_time_functions = 8
 
         i = num_time_functions*k
-        if k == 0:
-            m = num_time_functions*(k+1)
-            n = num_time_functions*(Nk_path-1)
-        elif k == Nk_path-1:
-            m = 0
-            n = num_time_functions*(k-1)
-        else:
-            m = num_time_functions*(k+1)
-            n = num_time_functions*(k-1)
+        m = m_idx[k]
+        n = n_idx[k]
 
         # Energy term eband(i,k) the energy of band i at point k
         ecv = ecv_in_path[k]
@@ -1210,27 +1383,27 @@ def fnumba(t, y, kpath, dk, gamma1, gamma2, E0, B0, w, chirp, alpha, phase, do_B
         ec =  ecv_in_path[k]/2
 
         # Rabi frequency: w_R = d_12(k).E(t)
-        dipole = dipole_in_path[k]
-        wr = rabi(E0, t, dipole)
+        wr = wr_in_path[k]
         wr_c = wr.conjugate()
 
         # Rabi frequency: w_R = (d_11(k) - d_22(k))*E(t)
-        Berry_con_diff = A_in_path[k]
-        wr_d_diag      = rabi(E0, t, Berry_con_diff)
-        Berry_con_v    = Avv_in_path[k]
-        wr_d_vv        = rabi(E0, t, Berry_con_v)
-        Berry_con_c    = Acc_in_path[k]
-        wr_d_cc        = rabi(E0, t, Berry_con_c)
+        wr_d_diag      = wr_d_diag_in_path[k]
+        wr_d_vv        = wr_d_vv_in_path[k]
+        wr_d_cc        = wr_d_cc_in_path[k]
 
         if dynamics_type == 'density_matrix_dynamics':
 
            # Update each component of the solution vector
            # i = f_v, i+1 = p_vc, i+2 = p_cv, i+3 = f_c
            # wr -> d_vc, wr_c -> d_vc
-           x[i] = 2*(wr*y[i+1]).imag + D*(y[m] - y[n]) - gamma1*(y[i]-y0_np[i])
-           x[i+1] = (1j*ecv - gamma2 + 1j*wr_d_diag)*y[i+1] - 1j*wr_c*(y[i]-y[i+3]) + D*(y[m+1] - y[n+1])
-           x[i+2] = x[i+1].conjugate()
-           x[i+3] = -2*(wr*y[i+1]).imag + D*(y[m+3] - y[n+3]) - gamma1*(y[i+3]-y0_np[i+3])
+           # 2*Im(wr*p_vc) from the real and imaginary parts, shared by f_v and f_c
+           df = 2*(wr.real*y[i+1].imag + wr.imag*y[i+1].real)
+           x[i] = df + D*(y[m] - y[n]) - gamma1*(y[i]-y0_np[i])
+           # p_cv is the conjugate of p_vc, both are stored from the same local value
+           x_vc = (1j*ecv - gamma2 + 1j*wr_d_diag)*y[i+1] - 1j*wr_c*(y[i]-y[i+3]) + D*(y[m+1] - y[n+1])
+           x[i+1] = x_vc
+           x[i+2] = x_vc.conjugate()
+           x[i+3] = -df + D*(y[m+3] - y[n+3]) - gamma1*(y[i+3]-y0_np[i+3])
            x[i+4] = 0
            x[i+5] = 0
            x[i+6] = 0
@@ -1257,9 +1430,9 @@ def fnumba(t, y, kpath, dk, gamma1, gamma2, E0, B0, w, chirp, alpha, phase, do_B
 
                dipole_in_path_B = E_dir[0]*di_01x_B_field + E_dir[1]*di_01y_B_field
                A_in_path_B      = E_dir[0]*di_00x_B_field + E_dir[1]*di_00y_B_field - (E_dir[0]*di_11x_B_field + E_dir[1]*di_11y_B_field)
-               wr_B             = rabi(E0, t, dipole_in_path_B)
+               wr_B             = dipole_in_path_B*E_t
                wr_B_c           = wr_B.conjugate()
-               wr_d_diag_B      = rabi(E0, t, A_in_path_B)
+               wr_d_diag_B      = A_in_path_B*E_t
                ecv_in_path_B    = sys.ecjit   (kx=kx_shifted_path_c, ky=ky_shifted_path_c) \
                                 - sys.evjit   (kx=kx_shifted_path_v, ky=ky_shifted_path_v)
 #               if Bcurv_in_B_dynamics: 
@@ -1270,21 +1443,23 @@ def fnumba(t, y, kpath, dk, gamma1, gamma2, E0, B0, w, chirp, alpha, phase, do_B
                Bcurv_c = 0
 
                # use the unnecessary entry i+2 to compute the k-point shift 
-               B_z = driving_field(B0, t)
-               E_x = driving_field(E0, t) * E_dir[0]
-               E_y = driving_field(E0, t) * E_dir[1]
-               x[i]   = 2*(wr_B*y[i+1]).imag - gamma1*(y[i]-y0_np[i])
-               x[i+1] = (1j*ecv_in_path_B - gamma2 + 1j*wr_d_diag_B)*y[i+1] - 1j*wr_B_c*(y[i]-y[i+3]) 
-               x[i+2] = x[i+1].conjugate()
-               x[i+3] = -2*(wr_B*y[i+1]).imag - gamma1*(y[i+3]-y0_np[i+3])
+               B_z = B_t
+               E_x = E_t * E_dir[0]
+               E_y = E_t * E_dir[1]
+               df_B   = 2*(wr_B.real*y[i+1].imag + wr_B.imag*y[i+1].real)
+               x[i]   = df_B - gamma1*(y[i]-y0_np[i])
+               x_vc   = (1j*ecv_in_path_B - gamma2 + 1j*wr_d_diag_B)*y[i+1] - 1j*wr_B_c*(y[i]-y[i+3])
+               x[i+1] = x_vc
+               x[i+2] = x_vc.conjugate()
+               x[i+3] = -df_B - gamma1*(y[i+3]-y0_np[i+3])
                # k_v_x
-               x[i+4] = - driving_field(E0, t)*E_dir[0] - B_z*(ev_dy + Bcurv_v*E_x) / (1 - Bcurv_v*B_z)
+               x[i+4] = - E_x - B_z*(ev_dy + Bcurv_v*E_x) / (1 - Bcurv_v*B_z)
                # k_v_y
-               x[i+5] = - driving_field(E0, t)*E_dir[1] + B_z*(ev_dx - Bcurv_v*E_y) / (1 - Bcurv_v*B_z)
+               x[i+5] = - E_y + B_z*(ev_dx - Bcurv_v*E_y) / (1 - Bcurv_v*B_z)
                # k_c_x
-               x[i+6] = - driving_field(E0, t)*E_dir[0] - B_z*(ec_dy + Bcurv_c*E_x) / (1 - Bcurv_c*B_z)
+               x[i+6] = - E_x - B_z*(ec_dy + Bcurv_c*E_x) / (1 - Bcurv_c*B_z)
                # k_v_y
-               x[i+7] = - driving_field(E0, t)*E_dir[1] + B_z*(ec_dx - Bcurv_c*E_y) / (1 - Bcurv_c*B_z)
+               x[i+7] = - E_y + B_z*(ec_dx - Bcurv_c*E_y) / (1 - Bcurv_c*B_z)
 
         elif dynamics_type == 'wavefunction_dynamics':
 
@@ -1300,10 +1475,62 @@ def fnumba(t, y, kpath, dk, gamma1, gamma2, E0, B0, w, chirp, alpha, phase, do_B
            x[i+7] = 0
 
     # last component of x is the E-field to obtain the vector potential A(t)
-    x[-1] = -driving_field(E0, t)
+    x[-1] = -E_t
 
     return x
 
+class BDF_init(BDF):
+    '''
+    scipy BDF solver with its whole array of backward differences initialized, as in SBE_SC.py.
+    scipy only sets the first two rows, but the first step already subtracts the third one.
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.D[2:] = 0
+
+def jac_sparse_parts(dk, gamma1, gamma2, ecv_in_path, dipole_in_path, A_in_path, m_idx, n_idx):
+    '''
+    Sparse parts of the Jacobian of fnumba in the length gauge without B-field, J = J0 + E(t)*J1.
+    As in SBE_SC.py the imaginary parts are written with p_cv = conj(p_vc) and real occupations,
+    e.g. 2*Im(wr*p_vc) = -1j*(wr*p_vc - wr_c*p_cv), so the right hand side is linear and holomorphic in y.
+    The entries i+4...i+7 and the A-field do not depend on y, their rows are empty.
+    '''
+    Nk = ecv_in_path.size
+    i  = 8*np.arange(Nk)
+    n_y = 8*Nk + 1
+
+    # Damping and band energies do not depend on the driving field
+    diag_pvc = 1j*ecv_in_path - gamma2
+    J0 = sparse.coo_matrix((np.concatenate((np.full(Nk, -gamma1, dtype=np.complex128), diag_pvc, np.conj(diag_pvc),
+                                            np.full(Nk, -gamma1, dtype=np.complex128))),
+                            (np.concatenate((i, i+1, i+2, i+3)), np.concatenate((i, i+1, i+2, i+3)))),
+                           shape=(n_y, n_y)).tocsr()
+
+    # Coefficients of E(t)
+    wr        = dipole_in_path
+    wr_c      = wr.conjugate()
+    wr_d_diag = A_in_path
+    grad      = np.full(Nk, 1/(2*dk), dtype=np.complex128)
+
+    # Gradient term couples each component to the same component at the neighbouring k-points
+    rows = [i+j for j in range(4)] + [i+j for j in range(4)]
+    cols = [m_idx+j for j in range(4)] + [n_idx+j for j in range(4)]
+    vals = [grad]*4 + [-grad]*4
+
+    for row, col, val in ((i, i+1, -1j*wr), (i, i+2, 1j*wr_c),
+                          (i+1, i, -1j*wr_c), (i+1, i+1, 1j*wr_d_diag), (i+1, i+3, 1j*wr_c),
+                          (i+2, i, 1j*wr), (i+2, i+2, -1j*wr_d_diag.conjugate()), (i+2, i+3, -1j*wr),
+                          (i+3, i+1, 1j*wr), (i+3, i+2, -1j*wr_c)):
+        rows.append(row)
+        cols.append(col)
+        vals.append(val)
+
+    # Duplicate entries (only for very short paths) are summed by the conversion
+    J1 = sparse.coo_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+                           shape=(n_y, n_y)).tocsr()
+
+    return J0, J1
+
 '''
 OUT OF DATE/NOT FUNCTIONAL! FOR FUTURE WORK ON MAGNETIC FIELD IMPLEMENTATION.
 '''
@@ -1444,18 +1671,25 @@ def shift_solution(solution, A_field, dk, dynamics_type):
     return solution
 
 
-def initial_condition(y0,e_fermi,temperature,e_c,i_k,dynamics_type):
+def initial_condition(e_fermi,temperature,e_c,dynamics_type):
+    knum = e_c.size
+
+    # Eight entries per k-point, the last entry of the state vector is the A-field
+    y0 = np.zeros(8*knum+1, dtype=np.complex128)
     if dynamics_type == 'density_matrix_dynamics':
+        y0[0:-1:8] = 1.0
         if (temperature > 1e-5):
-            fermi_function = 1/(np.exp((e_c[i_k]-e_fermi)/temperature)+1)
-            y0.extend([1.0,0.0,0.0,fermi_function,0.0,0.0,0.0,0.0])
-        else:
-            y0.extend([1.0,0.0,0.0,0.0,0.0,0.0,0.0,0.0])
+            y0[3:-1:8] = 1/(np.exp((e_c-e_fermi)/temperature)+1)
     elif dynamics_type == 'wavefunction_dynamics':
-        y0.extend([1.0,0.0,0.0,1.0,0.0,0.0,0.0,0.0])
+        y0[0:-1:8] = 1.0
+        y0[3:-1:8] = 1.0
+    return y0
 
 
 def BZ_plot(kpnts,a,b1,b2,E_dir,paths):
+    import matplotlib.pyplot as pl
+    from matplotlib import patches
+    from matplotlib.collections import PatchCollection
 
     R = 4.0*np.pi/(3*a)
     r = 2.0*np.pi/(np.sqrt(3)*a)
@@ -1463,13 +1697,10 @@ def BZ_plot(kpnts,a,b1,b2,E_dir,paths):
     BZ_fig = pl.figure(figsize=(10,10))
     ax = BZ_fig.add_subplot(111,aspect='equal')
 
-    ax.add_patch(patches.RegularPolygon((0,0),6,radius=R,orientation=np.pi/6,fill=False))
-    ax.add_patch(patches.RegularPolygon(b1,6,radius=R,orientation=np.pi/6,fill=False))
-    ax.add_patch(patches.RegularPolygon(-b1,6,radius=R,orientation=np.pi/6,fill=False))
-    ax.add_patch(patches.RegularPolygon(b2,6,radius=R,orientation=np.pi/6,fill=False))
-    ax.add_patch(patches.RegularPolygon(-b2,6,radius=R,orientation=np.pi/6,fill=False))
-    ax.add_patch(patches.RegularPolygon(b1+b2,6,radius=R,orientation=np.pi/6,fill=False))
-    ax.add_patch(patches.RegularPolygon(-b1-b2,6,radius=R,orientation=np.pi/6,fill=False))
+    # First Brillouin zone and its six neighbours, drawn as one collection
+    centers = [(0,0), b1, -b1, b2, -b2, b1+b2, -b1-b2]
+    ax.add_collection(PatchCollection([patches.RegularPolygon(c,6,radius=R,orientation=np.pi/6,fill=False)
+                                       for c in centers], match_original=True))
 
     ax.arrow(-0.5*E_dir[0],-0.5*E_dir[1],E_dir[0],E_dir[1],width=0.005,alpha=0.5,label='E-field')
 
@@ -1486,7 +1717,6 @@ def BZ_plot(kpnts,a,b1,b2,E_dir,paths):
     pl.ylabel(r'$k_y$ ($1/a_0$)')
 
     for path in paths:
-        path = np.array(path)
         pl.plot(path[:,0],path[:,1])
 
     return
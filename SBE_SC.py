@@ -1,9 +1,18 @@
 import params
+import os
 import numpy as np
-from numba import njit
-import matplotlib.pyplot as pl
-from matplotlib import patches
-from scipy.integrate import ode
+from numba import njit, prange, cuda, config, set_num_threads
+from scipy.integrate import ode, solve_ivp, BDF
+from scipy.fft import rfft, rfftfreq
+from scipy import sparse
+from multiprocessing import get_context
+import signal
+
+# Precision of the density matrix, single precision halves the memory traffic of the propagation
+DTYPE_C = np.complex64 if params.single_precision else np.complex128
+DTYPE_R = np.float32 if params.single_precision else np.float64
+# Tolerances of the adaptive RK45 scheme, they have to stay above the rounding error of the precision
+RTOL, ATOL = (1e-5, 1e-7) if params.single_precision else (1e-6, 1e-12)
 
 '''
 TO DO:
@@ -49,7 +58,10 @@ def main():
     t0 = int(params.t0*fs_conv)                       # Initial time condition
     tf = int(params.tf*fs_conv)                       # Final time
     dt = params.dt*fs_conv                            # Integration time step
-    dt_out = 1/(2*params.dt)                          # Solution output time step
+    # Solution output time step in integration steps. For a dt where 1/(2*dt) is not an integer the stride is
+    # rounded, so the output time grid (and with it the frequency grid of the emission spectra) differs from the
+    # float stride of SBE.py, which only ever matches the first time step in that case
+    dt_out = max(1, int(round(1/(2*params.dt))))
 
     # Brillouin zone type
     BZ_type = params.BZ_type                          # Type of Brillouin zone to construct
@@ -74,6 +86,9 @@ def main():
     energy_plots = params.energy_plots
     dipole_plots = params.dipole_plots
     test = params.test                                # Testing flag for Travis
+    n_proc = params.n_proc or os.cpu_count()          # Number of processes solving the paths
+    batch_paths = params.batch_paths                  # Propagate all paths in one state vector
+    solver_method = params.solver_method              # ODE solver used for the time propagation
 
     # USER OUTPUT
     ###############################################################################################
@@ -110,13 +125,13 @@ def main():
         E_dir = np.array([np.cos(np.radians(angle_inc_E_field)),np.sin(np.radians(angle_inc_E_field))])
         dk, kpnts, paths = mesh(params, E_dir)
 
-    # Number of integration steps, time array construction flag
+    # Number of integration steps and of output steps
     Nt = int((tf-t0)/dt)
-    t_constructed = False
+    n_out = np.count_nonzero(np.arange(Nt)%dt_out == 0)
 
     # Solution containers
     t                           = []
-    solution                    = []
+    solution                    = np.empty((np.size(paths,0), n_out, 4*np.size(paths,1)), dtype=DTYPE_C)
     dipole_E_dir                = []
     berry_conn_E_dir            = []
     dipole_x                    = []
@@ -124,77 +139,38 @@ def main():
     val_band                    = []
     cond_band                   = []
 
-    # Initialize the ode solver
-    solver = ode(f, jac=None).set_integrator('zvode', method='bdf', max_step=dt)
+    # Arguments passed to the path solver besides the path itself
+    path_args = (t0, dt, Nt, dt_out, n_out, dk, gamma2, E0, w, chirp, alpha, phase, e_fermi, temperature, a, delta0, delta1, user_out, solver_method)
 
     # SOLVING
     ###############################################################################################
-    # Iterate through each path in the Brillouin zone
-    path_num = 1
-    for path in paths:
-        if user_out: print('path: ' + str(path_num))
-
-        # Solution container for the current path
-        path_solution = []
-
-        # Retrieve the set of k-points for the current path
-        kx_in_path = path[:,0]
-        ky_in_path = path[:,1]
-
-        # Calculate the dot products E_dir.d_nm(k). To be multiplied by E-field magnitude later.
-        # A[0,1,:] means 0-1 offdiagonal element
-        dipole_in_path = 1.0
-        A_in_path      = 1.0
-
-        # in bite.evaluate, there is also an interpolation done if b1, b2 are provided and a cutoff radius
-        bandstruct = energies(kx_in_path,ky_in_path,a,delta0,delta1)
-        ecv_in_path = bandstruct[1] - bandstruct[0]
-
-        # Initialize the values of of each k point vector (rho_nn(k), rho_nm(k), rho_mn(k), rho_mm(k))
-        y0 = initial_condition(e_fermi,temperature,bandstruct[1])
-
-        # Set the initual values and function parameters for the current kpath
-        solver.set_initial_value(y0,t0).set_f_params(path,dk,gamma2,E0,w,chirp,alpha,phase,ecv_in_path,dipole_in_path,A_in_path)
-
-        # Propagate through time
-        ti = 0
-        while solver.successful() and ti < Nt:
-            # User output of integration progress
-            if (ti%1000 == 0 and user_out):
-                print('{:5.2f}%'.format(ti/Nt*100))
-
-            # Integrate one integration time step
-            solver.integrate(solver.t + dt)
-
-            # Save solution each output step
-            if ti%dt_out == 0:
-                path_solution.append(solver.y)
-                # Construct time array only once
-                if not t_constructed:
-                    t.append(solver.t)
-
-            # Increment time counter
-            ti += 1
-
-        # Flag that time array has been built up
-        t_constructed = True
-        path_num += 1
-
-        # Append path solutions to the total solution arrays
-        solution.append(path_solution)
+    # Iterate through each path in the Brillouin zone. The paths are independent of each other,
+    # so they are distributed over n_proc worker processes if requested.
+    if solver_method == 'cuda':
+        # All paths are propagated at once on the GPU
+        t, solution = solve_paths_cuda(paths, *path_args[:-2])
+    elif batch_paths:
+        # All paths are propagated at once, the component blocks of the state hold all paths
+        n_paths, Nk_path = np.size(paths,0), np.size(paths,1)
+        t, batch_solution = solve_path(paths, 'all', *path_args)
+        solution[:] = batch_solution.reshape(n_out, 4, n_paths, Nk_path).transpose(2, 0, 1, 3).reshape(n_paths, n_out, 4*Nk_path)
+    else:
+        if n_proc > 1:
+            results = solve_paths_pool(paths, n_proc, *path_args)
+        else:
+            results = []
+            path_num = 1
+            for path in paths:
+                results.append(solve_path(path, path_num, *path_args))
+                path_num += 1
 
-    # Convert solution and time array to numpy arrays
-    t        = np.array(t)
-    solution = np.array(solution)
+        # Write path solutions to the total solution array, the time array is the same for all paths
+        t = results[0][0]
+        for i_path, (path_t, path_solution) in enumerate(results):
+            solution[i_path] = path_solution
 
     # Slice solution along each path for easier observable calculation
-    if BZ_type == 'full':
-        solution = np.array_split(solution,Nk1,axis=2)
-    elif BZ_type == '2line':
-        solution = np.array_split(solution,Nk_in_path,axis=2)
-
-    # Convert lists into numpy arrays
-    solution         = np.array(solution)
+    solution = solution.reshape(np.size(paths,0), n_out, 4, np.size(paths,1)).transpose(3, 0, 1, 2)
     # Now the solution array is structred as: first index is kx-index, second is ky-index, third is timestep, fourth is f_h, p_he, p_eh, f_e
 
     # COMPUTE OBSERVABLES
@@ -203,30 +179,33 @@ def main():
     # Polarization (interband)
     P_E_dir, P_ortho = polarization(paths, solution[:,:,:,1], E_dir)
     # Current (intraband)
-    J_E_dir, J_ortho = current(paths, solution[:,:,:,0], solution[:,:,:,3], path, t, alpha, E_dir, delta0, delta1,a)
+    J_E_dir, J_ortho = current(paths, solution[:,:,:,0], solution[:,:,:,3], t, alpha, E_dir, delta0, delta1,a)
+    # Time derivative of the polarization and enveloped current, reused for the Fourier transforms
+    envelope    = Gaussian_envelope(t,alpha)
+    dP_E_dir    = diff(t,P_E_dir)
+    dP_ortho    = diff(t,P_ortho)
+    J_env_E_dir = J_E_dir*envelope
+    J_env_ortho = J_ortho*envelope
     # Emission in time
-    I_E_dir, I_ortho = diff(t,P_E_dir)*Gaussian_envelope(t,alpha) + J_E_dir*Gaussian_envelope(t,alpha), \
-                       diff(t,P_ortho)*Gaussian_envelope(t,alpha) + J_ortho*Gaussian_envelope(t,alpha)
+    I_E_dir, I_ortho = dP_E_dir*envelope + J_env_E_dir, \
+                       dP_ortho*envelope + J_env_ortho
     # Berry curvature current
     #J_Bcurv_E_dir, J_Bcurv_ortho = current_Bcurv(paths, solution[:,:,:,0], solution[:,:,:,3], bite, path, t, alpha, E_dir, E0, w, phase, dipole)
 
     # Polar emission in time
-    Ir = []
     angles = np.linspace(0,2.0*np.pi,360)
-    for angle in angles:
-        Ir.append((I_E_dir*np.cos(angle) + I_ortho*np.sin(-angle)))
+    Ir = I_E_dir[np.newaxis,:]*np.cos(angles)[:,np.newaxis] + I_ortho[np.newaxis,:]*np.sin(-angles)[:,np.newaxis]
 
-    # Fourier transforms
+    # Fourier transforms, the signals are real so only the non-negative frequencies are computed
     dt_out   = t[1]-t[0]
-    freq     = np.fft.fftshift(np.fft.fftfreq(np.size(t),d=dt_out))
-    Iw_E_dir = np.fft.fftshift(np.fft.fft(I_E_dir, norm='ortho'))
-    Iw_ortho = np.fft.fftshift(np.fft.fft(I_ortho, norm='ortho'))
-    Iw_r     = np.fft.fftshift(np.fft.fft(Ir, norm='ortho'))
-    Pw_E_dir = np.fft.fftshift(np.fft.fft(diff(t,P_E_dir), norm='ortho'))
-    Pw_ortho = np.fft.fftshift(np.fft.fft(diff(t,P_ortho), norm='ortho'))
-    Jw_E_dir = np.fft.fftshift(np.fft.fft(J_E_dir*Gaussian_envelope(t,alpha), norm='ortho'))
-    Jw_ortho = np.fft.fftshift(np.fft.fft(J_ortho*Gaussian_envelope(t,alpha), norm='ortho'))
-    fw_0     = np.fft.fftshift(np.fft.fft(solution[:,0,:,0], norm='ortho'),axes=(1,))
+    freq     = rfftfreq(np.size(t),d=dt_out)
+    Iw_E_dir = rfft(I_E_dir, norm='ortho')
+    Iw_ortho = rfft(I_ortho, norm='ortho')
+    Iw_r     = rfft(Ir, axis=1, norm='ortho', workers=-1)
+    Pw_E_dir = rfft(dP_E_dir, norm='ortho')
+    Pw_ortho = rfft(dP_ortho, norm='ortho')
+    Jw_E_dir = rfft(J_env_E_dir, norm='ortho')
+    Jw_ortho = rfft(J_env_ortho, norm='ortho')
 
     # Emission intensity
     Int_E_dir = (freq**2)*np.abs(freq*Pw_E_dir + 1j*Jw_E_dir)**2.0
@@ -237,13 +216,16 @@ def main():
         Nk1 = Nk_in_path
         Nk2 = 2
     J_filename = str('J_Nk1-{}_Nk2-{}_w{:4.2f}_E{:4.2f}_a{:4.2f}_ph{:3.2f}_T2-{:05.2f}').format(Nk1,Nk2,w/THz_conv,E0/E_conv,alpha/fs_conv,phase,T2/fs_conv)
-    np.save(J_filename, [t/fs_conv, J_E_dir, J_ortho, freq/w, Jw_E_dir, Jw_ortho])
+    np.savez_compressed(J_filename, t=t/fs_conv, J_E_dir=J_E_dir, J_ortho=J_ortho, freq=freq/w, Jw_E_dir=Jw_E_dir, Jw_ortho=Jw_ortho)
     P_filename = str('P_Nk1-{}_Nk2-{}_w{:4.2f}_E{:4.2f}_a{:4.2f}_ph{:3.2f}_T2-{:05.2f}').format(Nk1,Nk2,w/THz_conv,E0/E_conv,alpha/fs_conv,phase,T2/fs_conv)
-    np.save(P_filename, [t/fs_conv, P_E_dir, P_ortho, freq/w, Pw_E_dir, Pw_ortho])
+    np.savez_compressed(P_filename, t=t/fs_conv, P_E_dir=P_E_dir, P_ortho=P_ortho, freq=freq/w, Pw_E_dir=Pw_E_dir, Pw_ortho=Pw_ortho)
     I_filename = str('I_Nk1-{}_Nk2-{}_w{:4.2f}_E{:4.2f}_a{:4.2f}_ph{:3.2f}_T2-{:05.2f}').format(Nk1,Nk2,w/THz_conv,E0/E_conv,alpha/fs_conv,phase,T2/fs_conv)
-    np.save(I_filename, [t/fs_conv, I_E_dir, I_ortho, freq/w, np.abs(Iw_E_dir), np.abs(Iw_ortho), Int_E_dir, Int_ortho])
+    np.savez_compressed(I_filename, t=t/fs_conv, I_E_dir=I_E_dir, I_ortho=I_ortho, freq=freq/w, Iw_E_dir=np.abs(Iw_E_dir), Iw_ortho=np.abs(Iw_ortho),
+                        Int_E_dir=Int_E_dir, Int_ortho=Int_ortho)
 
     if (not test and user_out):
+        # matplotlib is only imported when plotting, runs without user output do not pay for the import
+        import matplotlib.pyplot as pl
         real_fig, ((axE,axP),(axPdot,axJ)) = pl.subplots(2,2,figsize=(10,10))
         t_lims = (-10*alpha/fs_conv, 10*alpha/fs_conv)
         freq_lims = (0,30)
@@ -258,8 +240,8 @@ def main():
         axP.set_xlabel(r'$t$ in fs')
         axP.set_ylabel(r'$P$ in atomic units $\parallel \mathbf{E}_{in}$ (blue), $\bot \mathbf{E}_{in}$ (orange)')
         axPdot.set_xlim(t_lims)
-        axPdot.plot(t/fs_conv,diff(t,P_E_dir))
-        axPdot.plot(t/fs_conv,diff(t,P_ortho))
+        axPdot.plot(t/fs_conv,dP_E_dir)
+        axPdot.plot(t/fs_conv,dP_ortho)
         axPdot.set_xlabel(r'$t$ in fs')
         axPdot.set_ylabel(r'$\dot P$ in atomic units $\parallel \mathbf{E}_{in}$ (blue), $\bot \mathbf{E}_{in}$ (orange)')
         axJ.set_xlim(t_lims)
@@ -345,6 +327,410 @@ def main():
 #################################################################################################
 # FUNCTIONS
 ################################################################################################
+def init_worker(n_threads):
+    '''
+    Worker initializer, Ctrl-C is handled by the main process which terminates the pool.
+    Each worker runs the right hand side on n_threads threads.
+    '''
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    set_num_threads(n_threads)
+
+def solve_paths_pool(paths, n_proc, *path_args):
+    '''
+    Propagates the paths on n_proc worker processes, returns the results of solve_path in path order.
+    The workers are spawned instead of forked, a fork of the threaded parent aborts with OpenMP
+    and hangs with TBB as numba's threading layer.
+    '''
+    # The threads of the parallel right hand side are shared out between the workers, the thread
+    # count is read from the configuration so that the threading layer is not started in the parent
+    n_threads = max(1, config.NUMBA_NUM_THREADS//n_proc)
+    pool = get_context('spawn').Pool(processes=n_proc, initializer=init_worker, initargs=(n_threads,))
+    try:
+        jobs = []
+        path_num = 1
+        for path in paths:
+            jobs.append(pool.apply_async(solve_path, (path, path_num) + path_args))
+            path_num += 1
+        pool.close()
+        results = [job.get() for job in jobs]
+        pool.join()
+    except KeyboardInterrupt:
+        pool.terminate()
+        pool.join()
+        raise
+    return results
+
+def solve_path(path, path_num, t0, dt, Nt, dt_out, n_out, dk, gamma2, E0, w, chirp, alpha, phase, e_fermi, temperature, a, delta0, delta1, user_out, solver_method):
+    '''
+    Propagates the density matrix of all k-points in a single path through time.
+    Several paths of shape (n_paths, Nk_path, 2) are propagated together as one state vector,
+    each component block then holds the k-points of all paths one path after the other.
+    Returns the time array and the solution at each output step.
+    '''
+    if user_out: print('path: ' + str(path_num))
+
+    # Retrieve the set of k-points for the current path(s)
+    Nk_path = np.size(path,-2)
+    path = path.reshape(-1,2)
+    kx_in_path = path[:,0]
+    ky_in_path = path[:,1]
+
+    # Calculate the dot products E_dir.d_nm(k). To be multiplied by E-field magnitude later.
+    # A[0,1,:] means 0-1 offdiagonal element
+    dipole_in_path = 1.0
+    A_in_path      = 1.0
+
+    # in bite.evaluate, there is also an interpolation done if b1, b2 are provided and a cutoff radius
+    bandstruct = energies(kx_in_path,ky_in_path,a,delta0,delta1)
+    ecv_in_path = (bandstruct[1] - bandstruct[0]).astype(DTYPE_R)
+
+    # Time independent part of the p_vc equation, -i*e_cv(k) - gamma2, set up once per path
+    h0_in_path = (-1j*ecv_in_path - gamma2).astype(DTYPE_C)
+
+    # Index of the next (m) and previous (n) k-point of each k-point, periodic in k within each path
+    k_in_path = np.arange(np.size(path,0))
+    path_start = k_in_path - k_in_path % Nk_path
+    m_idx = path_start + (k_in_path+1) % Nk_path
+    n_idx = path_start + (k_in_path-1) % Nk_path
+
+    # Initialize the values of of each k point vector (rho_nn(k), rho_nm(k), rho_mn(k), rho_mm(k))
+    y0 = initial_condition(e_fermi,temperature,bandstruct[1])
+
+    # The whole time propagation is done in a single compiled call
+    if solver_method == 'rk45':
+        return integrate_path(y0, t0, dt, Nt, dt_out, n_out, path, dk, E0, w, chirp, alpha, phase,
+                              h0_in_path, dipole_in_path, A_in_path, m_idx, n_idx, RTOL, ATOL)
+    if solver_method == 'rk4':
+        n_sub = rk4_substeps(dt, dk, gamma2, E0, ecv_in_path, dipole_in_path, A_in_path)
+        # The driving field is tabulated once on the grid of half substeps the RK4 stages sit on
+        E_tab = driving_field(E0, w, t0 + dt/n_sub/2*np.arange(2*Nt*n_sub+1), chirp, alpha, phase)
+        return integrate_path_rk4(y0, t0, dt, Nt, dt_out, n_out, n_sub, E_tab, dk,
+                                  h0_in_path, dipole_in_path, A_in_path, m_idx, n_idx)
+
+    # Solution containers for the current path
+    # The output times are fixed by the time grid, the solution is saved after every dt_out'th time step
+    # starting with the first
+    t = t0 + (np.arange(n_out)*dt_out + 1)*dt
+
+    if solver_method == 'bdf_sparse':
+        # The Jacobian is J0 + E(t)*J1 with sparse matrices set up once, so the BDF solver factorizes
+        # it with a sparse LU instead of the dense LU of zvode
+        J0, J1 = jac_sparse_parts(dk, h0_in_path, dipole_in_path, A_in_path, m_idx, n_idx)
+        f_params = (path,dk,E0,w,chirp,alpha,phase,h0_in_path,dipole_in_path,A_in_path,m_idx,n_idx)
+        sol = solve_ivp(fnumba, (t0, t[-1]), y0, method=BDF_init, t_eval=t, args=f_params, max_step=dt,
+                        rtol=RTOL, atol=ATOL, jac=lambda t, y, *args: J0 + driving_field(E0, w, t, chirp, alpha, phase)*J1)
+
+        # Output steps after a failed integration are left empty, as in the zvode loop
+        path_solution = np.empty((n_out, y0.size), dtype=DTYPE_C)
+        path_solution[:sol.y.shape[1]] = sol.y.T
+        return t, path_solution
+
+    path_solution = np.empty((n_out, y0.size), dtype=DTYPE_C)
+
+    # Initialize the ode solver, the jitted right hand side and Jacobian are called by zvode directly.
+    # The Adams methods of zvode are used with functional iteration, without any Jacobian
+    if solver_method == 'adams':
+        solver = ode(fnumba).set_integrator('zvode', method='adams', with_jacobian=False, max_step=dt)
+    else:
+        solver = ode(fnumba, jac_numba).set_integrator('zvode', method='bdf', max_step=dt)
+        solver.set_jac_params(path,dk,E0,w,chirp,alpha,phase,h0_in_path,dipole_in_path,A_in_path,m_idx,n_idx)
+
+    # Set the initual values and function parameters for the current kpath
+    solver.set_initial_value(y0,t0).set_f_params(path,dk,E0,w,chirp,alpha,phase,h0_in_path,dipole_in_path,A_in_path,m_idx,n_idx)
+
+    # Propagate through time, zvode is integrated directly from one output time step to the next
+    # and limits its internal step to dt
+    print_stride = max(1, 1000//dt_out)
+    for i_out in range(n_out):
+        # User output of integration progress
+        if (i_out%print_stride == 0 and user_out):
+            print('{:5.2f}%'.format(i_out*dt_out/Nt*100))
+
+        # Integrate up to and including the next output time step
+        solver.integrate(t[i_out])
+        if not solver.successful():
+            break
+
+        # Save solution
+        path_solution[i_out] = solver.y
+
+    return t, path_solution
+
+@njit
+def integrate_path(y0, t0, dt, Nt, dt_out, n_out, kpath, dk, E0, w, chirp, alpha, phase, h0_in_path, dipole_in_path, A_in_path, m_idx, n_idx, rtol, atol):
+    '''
+    Propagates y0 over Nt time steps of length dt with an adaptive Dormand-Prince (RK45)
+    scheme, the step size never exceeds dt. Returns the time array and the solution at
+    each output step, sampled in the same way as the zvode loop in solve_path.
+    '''
+    # Solution containers, the precision is taken from y0 instead of the global DTYPE_C
+    t_out = np.empty(n_out)
+    y_out = np.empty((n_out, y0.size), dtype=y0.dtype)
+
+    t = t0*1.0
+    y = y0.copy()
+    h = dt
+    k1 = fnumba(t, y, kpath, dk, E0, w, chirp, alpha, phase, h0_in_path, dipole_in_path, A_in_path, m_idx, n_idx)
+
+    i_out = 0
+    for ti in range(Nt):
+        # End of the current time step on the fixed time grid, so rounding errors do not accumulate
+        t_end = t0 + (ti + 1)*dt
+
+        # Adaptive steps until the end of the current time step is reached
+        while t < t_end:
+            last_step = h >= t_end - t
+            h_step = t_end - t if last_step else h
+
+            k2 = fnumba(t + h_step/5, y + h_step*(k1/5), kpath, dk, E0, w, chirp, alpha, phase, h0_in_path, dipole_in_path, A_in_path, m_idx, n_idx)
+            k3 = fnumba(t + 3*h_step/10, y + h_step*(3*k1/40 + 9*k2/40), kpath, dk, E0, w, chirp, alpha, phase,
+                        h0_in_path, dipole_in_path, A_in_path, m_idx, n_idx)
+            k4 = fnumba(t + 4*h_step/5, y + h_step*(44*k1/45 - 56*k2/15 + 32*k3/9), kpath, dk, E0, w, chirp, alpha, phase,
+                        h0_in_path, dipole_in_path, A_in_path, m_idx, n_idx)
+            k5 = fnumba(t + 8*h_step/9, y + h_step*(19372*k1/6561 - 25360*k2/2187 + 64448*k3/6561 - 212*k4/729), kpath, dk,
+                        E0, w, chirp, alpha, phase, h0_in_path, dipole_in_path, A_in_path, m_idx, n_idx)
+            k6 = fnumba(t + h_step, y + h_step*(9017*k1/3168 - 355*k2/33 + 46732*k3/5247 + 49*k4/176 - 5103*k5/18656), kpath, dk,
+                        E0, w, chirp, alpha, phase, h0_in_path, dipole_in_path, A_in_path, m_idx, n_idx)
+            # Written into an array of the state dtype, so y keeps its precision
+            y_new = np.empty_like(y)
+            y_new[:] = y + h_step*(35*k1/384 + 500*k3/1113 + 125*k4/192 - 2187*k5/6784 + 11*k6/84)
+            k7 = fnumba(t + h_step, y_new, kpath, dk, E0, w, chirp, alpha, phase, h0_in_path, dipole_in_path, A_in_path, m_idx, n_idx)
+
+            # Difference between the 5th and the embedded 4th order solution
+            err = h_step*(71*k1/57600 - 71*k3/16695 + 71*k4/1920 - 17253*k5/339200 + 22*k6/525 - k7/40)
+            scale = atol + rtol*np.maximum(np.abs(y), np.abs(y_new))
+            err_norm = np.sqrt(np.mean(np.abs(err/scale)**2))
+
+            if err_norm <= 1.0:
+                t = t_end if last_step else t + h_step
+                y = y_new
+                k1 = k7
+                if err_norm > 0.0:
+                    factor = min(5.0, max(0.2, 0.9*err_norm**(-0.2)))
+                else:
+                    factor = 5.0
+                # A step clamped to the end of the time step is usually much shorter than h, so h is
+                # kept for the next time step unless the error of the clamped step asks for a smaller one
+                if last_step and factor >= 1.0:
+                    h = max(h, h_step*factor)
+                else:
+                    h = h_step*factor
+            else:
+                h = h_step*max(0.2, 0.9*err_norm**(-0.2))
+            h = min(h, dt)
+
+        # Save solution each output step
+        if ti%dt_out == 0:
+            t_out[i_out] = t
+            y_out[i_out, :] = y
+            i_out += 1
+
+    return t_out, y_out
+
+def rk4_substeps(dt, dk, gamma2, E0, ecv, dipole_in_path, A_in_path):
+    '''
+    Number of substeps each time step dt is split into by the fixed-step RK4 schemes.
+    RK4 is only stable for h*|lambda| < 2.8, so the spectral radius of the right hand side is bounded.
+    '''
+    lambda_max = np.max(np.abs(ecv)) + gamma2 + E0*(2*abs(dipole_in_path) + abs(A_in_path)) + E0/dk
+    return max(1, int(np.ceil(dt*lambda_max/2.5)))
+
+@njit
+def integrate_path_rk4(y0, t0, dt, Nt, dt_out, n_out, n_sub, E_tab, dk, h0_in_path, dipole_in_path, A_in_path, m_idx, n_idx):
+    '''
+    Propagates y0 over Nt time steps of length dt with the classical RK4 scheme, each time step is
+    split into n_sub substeps. E_tab holds the driving field on the grid of half substeps.
+    Returns the time array and the solution at each output step, sampled in the same way as the
+    zvode loop in solve_path.
+    '''
+    # Solution containers
+    t_out = np.empty(n_out)
+    y_out = np.empty((n_out, y0.size), dtype=y0.dtype)
+
+    h = dt/n_sub
+    y = y0.copy()
+    y_stage = np.empty_like(y)
+
+    # The stages are written into the same arrays in every substep
+    k1 = np.empty_like(y)
+    k2 = np.empty_like(y)
+    k3 = np.empty_like(y)
+    k4 = np.empty_like(y)
+
+    i_out = 0
+    for ti in range(Nt):
+        for i_sub in range(n_sub):
+            i_E = 2*(ti*n_sub + i_sub)
+
+            fnumba_field(E_tab[i_E], y, k1, dk, h0_in_path, dipole_in_path, A_in_path, m_idx, n_idx)
+            y_stage[:] = y + h/2*k1
+            fnumba_field(E_tab[i_E+1], y_stage, k2, dk, h0_in_path, dipole_in_path, A_in_path, m_idx, n_idx)
+            y_stage[:] = y + h/2*k2
+            fnumba_field(E_tab[i_E+1], y_stage, k3, dk, h0_in_path, dipole_in_path, A_in_path, m_idx, n_idx)
+            y_stage[:] = y + h*k3
+            fnumba_field(E_tab[i_E+2], y_stage, k4, dk, h0_in_path, dipole_in_path, A_in_path, m_idx, n_idx)
+
+            # Written into the array of the state dtype, so y keeps its precision
+            y[:] = y + h/6*(k1 + 2*k2 + 2*k3 + k4)
+
+        # Save solution each output step
+        if ti%dt_out == 0:
+            t_out[i_out] = t0 + (ti + 1)*dt
+            y_out[i_out, :] = y
+            i_out += 1
+
+    return t_out, y_out
+
+def solve_paths_cuda(paths, t0, dt, Nt, dt_out, n_out, dk, gamma2, E0, w, chirp, alpha, phase, e_fermi, temperature, a, delta0, delta1):
+    '''
+    Propagates the density matrix of all paths at once on the GPU with a fixed-step RK4 scheme.
+    Each CUDA block integrates one path, its threads share the k-points of the path.
+    Only f_v, p_vc and f_c are propagated, p_cv is not integrated on the device but filled in as
+    conj(p_vc) in the output. This relies on the initial p_cv being conj(p_vc) (both are zero in
+    initial_condition), since the right hand side then keeps p_cv = conj(p_vc) as in fnumba_field.
+    Returns the time array and the solution of all paths at each output step.
+    '''
+    n_paths = np.size(paths,0)
+    Nk_path = np.size(paths,1)
+
+    # Constant dipoles as in solve_path
+    dipole_in_path = 1.0
+    A_in_path      = 1.0
+
+    # Band energies and initial values of all paths at once
+    bandstruct = energies(paths[:,:,0].ravel(),paths[:,:,1].ravel(),a,delta0,delta1).reshape(2, n_paths, Nk_path)
+    ecv = (bandstruct[1] - bandstruct[0]).astype(DTYPE_R)
+    y0  = initial_condition(e_fermi,temperature,bandstruct[1])
+
+    # Each time step dt is split into enough substeps for RK4 to be stable
+    n_sub = rk4_substeps(dt, dk, gamma2, E0, ecv, dipole_in_path, A_in_path)
+
+    # The RK4 stages of the fixed-step scheme sit on a grid of half substeps, so the driving field
+    # is tabulated there once instead of being evaluated inside the kernel
+    h = dt/n_sub
+    E_tab = driving_field(E0, w, t0 + h/2*np.arange(2*Nt*n_sub+1), chirp, alpha, phase)
+
+    # Index of the next (m) and previous (n) k-point of each k-point, periodic in k, the same for all paths
+    k_in_path = np.arange(Nk_path)
+    m_idx = (k_in_path+1) % Nk_path
+    n_idx = (k_in_path-1) % Nk_path
+
+    # Device arrays, the scratch arrays hold the intermediate stages of every path
+    y_d       = cuda.to_device(y0)
+    y_stage_d = cuda.device_array_like(y0)
+    k1_d      = cuda.device_array_like(y0)
+    k2_d      = cuda.device_array_like(y0)
+    k3_d      = cuda.device_array_like(y0)
+    k4_d      = cuda.device_array_like(y0)
+    h0_d      = cuda.to_device((-1j*ecv - gamma2).astype(DTYPE_C))
+    E_tab_d   = cuda.to_device(E_tab)
+    m_idx_d   = cuda.to_device(m_idx)
+    n_idx_d   = cuda.to_device(n_idx)
+    y_out_d   = cuda.device_array((n_paths, n_out, 4*Nk_path), dtype=DTYPE_C)
+
+    threads_per_block = min(Nk_path, 256)
+    rk4_paths_kernel[n_paths, threads_per_block](y_d, y_stage_d, k1_d, k2_d, k3_d, k4_d, y_out_d, E_tab_d, h, n_sub, Nt, dt_out,
+                                                 dk, h0_d, dipole_in_path, A_in_path, m_idx_d, n_idx_d)
+
+    # Only the sampled states are copied back, the times are the ends of the sampled time steps
+    ti = np.arange(Nt)
+    t = t0 + (ti[ti%dt_out == 0] + 1)*dt
+
+    return t, y_out_d.copy_to_host()
+
+@cuda.jit(device=True)
+def rhs_kpoint_device(y, x, k, Nk_path, E_t, dk, h0, dipole_in_path, A_in_path, m_idx, n_idx):
+    '''
+    Right hand side of fnumba for the k'th k-point of a single path, written into x.
+    The p_cv block is not propagated on the device, it is conj(p_vc) and only filled in the output.
+    '''
+    # Next (m) and previous (n) k-point, periodic in k. Component c of k-point k sits at c*Nk_path + k
+    m = m_idx[k]
+    n = n_idx[k]
+    i_v, i_vc, i_c = k, Nk_path + k, 3*Nk_path + k
+
+    D         = E_t/(2*dk)
+    wr        = dipole_in_path*E_t
+    wr_c      = wr.conjugate()
+    wr_d_diag = A_in_path*E_t
+
+    f_v  = y[i_v]
+    p_vc = y[i_vc]
+    f_c  = y[i_c]
+    df      = 2*(wr.real*p_vc.imag + wr.imag*p_vc.real)
+    x[i_v]  = df + D*(y[m] - y[n])
+    x[i_vc] = (h0 + 1j*wr_d_diag)*p_vc - 1j*wr_c*(f_v-f_c) + D*(y[Nk_path+m] - y[Nk_path+n])
+    x[i_c]  = -df + D*(y[3*Nk_path+m] - y[3*Nk_path+n])
+
+@cuda.jit
+def rk4_paths_kernel(y, y_stage, k1, k2, k3, k4, y_out, E_tab, h, n_sub, Nt, dt_out, dk, h0, dipole_in_path, A_in_path, m_idx, n_idx):
+    '''
+    One block per path, the threads of a block loop over the k-points of the path. The whole time
+    loop runs on the device, the block is synchronized between the RK4 stages because of the k-gradient.
+    E_tab holds the driving field on the grid of half substeps. The p_cv block of y and of the stages
+    is never read or written, it is assumed to be conj(p_vc) and only written to y_out as such.
+    '''
+    p        = cuda.blockIdx.x
+    tid      = cuda.threadIdx.x
+    n_thread = cuda.blockDim.x
+    Nk_path  = h0.shape[1]
+
+    y_p, y_stage_p = y[p], y_stage[p]
+    k1_p, k2_p, k3_p, k4_p = k1[p], k2[p], k3[p], k4[p]
+
+    i_out = 0
+    for ti in range(Nt):
+        for i_sub in range(n_sub):
+            i_E   = 2*(ti*n_sub + i_sub)
+            E_t   = E_tab[i_E]
+            E_mid = E_tab[i_E+1]
+            E_end = E_tab[i_E+2]
+
+            for k in range(tid, Nk_path, n_thread):
+                rhs_kpoint_device(y_p, k1_p, k, Nk_path, E_t, dk, h0[p,k], dipole_in_path, A_in_path, m_idx, n_idx)
+            cuda.syncthreads()
+            for k in range(tid, Nk_path, n_thread):
+                for c in (0, 1, 3):
+                    j = c*Nk_path + k
+                    y_stage_p[j] = y_p[j] + h/2*k1_p[j]
+            cuda.syncthreads()
+
+            for k in range(tid, Nk_path, n_thread):
+                rhs_kpoint_device(y_stage_p, k2_p, k, Nk_path, E_mid, dk, h0[p,k], dipole_in_path, A_in_path, m_idx, n_idx)
+            cuda.syncthreads()
+            for k in range(tid, Nk_path, n_thread):
+                for c in (0, 1, 3):
+                    j = c*Nk_path + k
+                    y_stage_p[j] = y_p[j] + h/2*k2_p[j]
+            cuda.syncthreads()
+
+            for k in range(tid, Nk_path, n_thread):
+                rhs_kpoint_device(y_stage_p, k3_p, k, Nk_path, E_mid, dk, h0[p,k], dipole_in_path, A_in_path, m_idx, n_idx)
+            cuda.syncthreads()
+            for k in range(tid, Nk_path, n_thread):
+                for c in (0, 1, 3):
+                    j = c*Nk_path + k
+                    y_stage_p[j] = y_p[j] + h*k3_p[j]
+            cuda.syncthreads()
+
+            for k in range(tid, Nk_path, n_thread):
+                rhs_kpoint_device(y_stage_p, k4_p, k, Nk_path, E_end, dk, h0[p,k], dipole_in_path, A_in_path, m_idx, n_idx)
+            cuda.syncthreads()
+            for k in range(tid, Nk_path, n_thread):
+                for c in (0, 1, 3):
+                    j = c*Nk_path + k
+                    y_p[j] += h/6*(k1_p[j] + 2*k2_p[j] + 2*k3_p[j] + k4_p[j])
+            cuda.syncthreads()
+
+        # Save solution each output step, every thread writes its own k-points
+        if ti%dt_out == 0:
+            for k in range(tid, Nk_path, n_thread):
+                y_out[p, i_out, k]             = y_p[k]
+                y_out[p, i_out, Nk_path+k]     = y_p[Nk_path+k]
+                y_out[p, i_out, 2*Nk_path+k]   = y_p[Nk_path+k].conjugate()
+                y_out[p, i_out, 3*Nk_path+k]   = y_p[3*Nk_path+k]
+            i_out += 1
+
 def mesh(params, E_dir):
     Nk_in_path = params.Nk_in_path                    # Number of kpoints in each of the two paths
     rel_dist_to_Gamma = params.rel_dist_to_Gamma      # relative distance (in units of 2pi/a) of both paths to Gamma
@@ -356,104 +742,83 @@ def mesh(params, E_dir):
 
     vec_k_ortho = 2.0*np.pi/a*rel_dist_to_Gamma*np.array([E_dir[1],-E_dir[0]])
 
-    # Containers for the mesh, and BZ directional paths
-    mesh = []
-    paths = []
-
-    # Create the kpoint mesh and the paths
-    for path_index in [-1,1]:
-        # Container for a single path
-        path = []
-        for alpha in alpha_array:
-            # Create a k-point
-            kpoint = path_index*vec_k_ortho + alpha*vec_k_path
-
-            mesh.append(kpoint)
-            path.append(kpoint)
-
-        # Append the a1'th path to the paths array
-        paths.append(path)
+    # Create the kpoint mesh and the paths, the paths are shifted by -/+ vec_k_ortho from Gamma
+    path_index = np.array([-1,1])
+    paths = path_index[:,np.newaxis,np.newaxis]*vec_k_ortho + alpha_array[np.newaxis,:,np.newaxis]*vec_k_path
+    mesh = paths.reshape(-1,2)
 
     dk = 1.0/Nk_in_path*length_path_in_BZ
 
-    return dk, np.array(mesh), np.array(paths)
-
+    return dk, mesh, paths
+
+@njit(cache=True)
+def is_in_hex(x,y,a):
+    # Returns true if the point is in the hexagonal BZ.
+    # Checks if the absolute values of x and y components of p are within the first quadrant of the hexagon.
+    x = np.abs(x)
+    y = np.abs(y)
+    return ((y <= 2.0*np.pi/(3*a)) and (np.sqrt(3.0)*x + y <= 4*np.pi/(3*a)))
+
+@njit(cache=True)
+def reflect_point(x,y,a,b1,b2):
+    if (y > 2*np.pi/(3*a)):   # Crosses top
+        x, y = x - b2[0], y - b2[1]
+    elif (y < -2*np.pi/(3*a)): # Crosses bottom
+        x, y = x + b2[0], y + b2[1]
+    elif (np.sqrt(3)*x + y > 4*np.pi/(3*a)): #Crosses top-right
+        x, y = x - (b1[0] + b2[0]), y - (b1[1] + b2[1])
+    elif (-np.sqrt(3)*x + y < -4*np.pi/(3*a)): #Crosses bot-right
+        x, y = x - b1[0], y - b1[1]
+    elif (np.sqrt(3)*x + y < -4*np.pi/(3*a)): #Crosses bot-left
+        x, y = x + (b1[0] + b2[0]), y + (b1[1] + b2[1])
+    elif (-np.sqrt(3)*x + y > 4*np.pi/(3*a)): #Crosses top-left
+        x, y = x + b1[0], y + b1[1]
+    return x, y
+
+@njit(cache=True)
 def hex_mesh(Nk1, Nk2, a, b1, b2, align):
-    alpha1 = np.linspace(-0.5 + (1/(2*Nk1)), 0.5 - (1/(2*Nk1)), num = Nk1)
-    alpha2 = np.linspace(-0.5 + (1/(2*Nk2)), 0.5 - (1/(2*Nk2)), num = Nk2)
-
-    def is_in_hex(p,a):
-        # Returns true if the point is in the hexagonal BZ.
-        # Checks if the absolute values of x and y components of p are within the first quadrant of the hexagon.
-        x = np.abs(p[0])
-        y = np.abs(p[1])
-        return ((y <= 2.0*np.pi/(3*a)) and (np.sqrt(3.0)*x + y <= 4*np.pi/(3*a)))
-
-    def reflect_point(p,a,b1,b2):
-        x = p[0]
-        y = p[1]
-        if (y > 2*np.pi/(3*a)):   # Crosses top
-            p -= b2
-        elif (y < -2*np.pi/(3*a)): # Crosses bottom
-            p += b2
-        elif (np.sqrt(3)*x + y > 4*np.pi/(3*a)): #Crosses top-right
-            p -= b1 + b2
-        elif (-np.sqrt(3)*x + y < -4*np.pi/(3*a)): #Crosses bot-right
-            p -= b1
-        elif (np.sqrt(3)*x + y < -4*np.pi/(3*a)): #Crosses bot-left
-            p += b1 + b2
-        elif (-np.sqrt(3)*x + y > 4*np.pi/(3*a)): #Crosses top-left
-            p += b1
-        return p
-
-
-    # Containers for the mesh, and BZ directional paths
-    mesh = []
-    paths = []
+    alpha1 = np.linspace(-0.5 + (1/(2*Nk1)), 0.5 - (1/(2*Nk1)), Nk1)
+    alpha2 = np.linspace(-0.5 + (1/(2*Nk2)), 0.5 - (1/(2*Nk2)), Nk2)
+
+    # Containers for the BZ directional paths, the mesh is the same set of points
+    paths = np.empty((Nk2, Nk1, 2))
 
     # Create the Monkhorst-Pack mesh
     if align == 'M':
-        for a2 in alpha2:
-            # Container for a single gamma-M path
-            path_M = []
-            for a1 in alpha1:
+        for i2 in range(Nk2):
+            for i1 in range(Nk1):
                 # Create a k-point
-                kpoint = a1*b1 + a2*b2
-                # If the current point is in the BZ, append it to the mesh and path_M
-                if (is_in_hex(kpoint,a)):
-                    mesh.append(kpoint)
-                    path_M.append(kpoint)
-                # If the current point is NOT in the BZ, reflect is along the appropriate axis to get it in the BZ, then append.
-                else:
-                    while (is_in_hex(kpoint,a) != True):
-                        kpoint = reflect_point(kpoint,a,b1,b2)
-                    mesh.append(kpoint)
-                    path_M.append(kpoint)
-            # Append the a1'th path to the paths array
-            paths.append(path_M)
+                kx = alpha1[i1]*b1[0] + alpha2[i2]*b2[0]
+                ky = alpha1[i1]*b1[1] + alpha2[i2]*b2[1]
+                # If the current point is NOT in the BZ, reflect is along the appropriate axis to get it in the BZ.
+                while not is_in_hex(kx,ky,a):
+                    kx, ky = reflect_point(kx,ky,a,b1,b2)
+                paths[i2,i1,0] = kx
+                paths[i2,i1,1] = ky
 
     elif align == 'K':
-        b_a1 = 8*np.pi/(a*np.sqrt(3)*3)*np.array([1,0])
-        b_a2 = 4*np.pi/(a*np.sqrt(3)*3)*np.array([1,np.sqrt(3)])
+        b_a1 = 8*np.pi/(a*np.sqrt(3)*3)*np.array([1.0,0.0])
+        b_a2 = 4*np.pi/(a*np.sqrt(3)*3)*np.array([1.0,np.sqrt(3)])
+        shift = 2*np.pi/(a*np.sqrt(3))*np.array([1.0,1/np.sqrt(3)])
         # Extend over half of the b2 direction and 1.5x the b1 direction (extending into the 2nd BZ to get correct boundary conditions)
-        alpha1 = np.linspace(-0.5 + (1/(2*Nk1)), 1.0 - (1/(2*Nk1)), num = Nk1)
-        alpha2 = np.linspace(0, 0.5 - (1/(2*Nk2)), num = Nk2)
-        for a2 in alpha2:
-            path_K = []
-            for a1 in alpha1:
-                kpoint = a1*b_a1 + a2*b_a2
-                if is_in_hex(kpoint,a):
-                    mesh.append(kpoint)
-                    path_K.append(kpoint)
-                else:
-                    kpoint -= 2*np.pi/(a*np.sqrt(3))*np.array([1,1/np.sqrt(3)])
-                    mesh.append(kpoint)
-                    path_K.append(kpoint)
-            paths.append(path_K)
+        alpha1 = np.linspace(-0.5 + (1/(2*Nk1)), 1.0 - (1/(2*Nk1)), Nk1)
+        alpha2 = np.linspace(0, 0.5 - (1/(2*Nk2)), Nk2)
+        for i2 in range(Nk2):
+            for i1 in range(Nk1):
+                kx = alpha1[i1]*b_a1[0] + alpha2[i2]*b_a2[0]
+                ky = alpha1[i1]*b_a1[1] + alpha2[i2]*b_a2[1]
+                if not is_in_hex(kx,ky,a):
+                    kx -= shift[0]
+                    ky -= shift[1]
+                paths[i2,i1,0] = kx
+                paths[i2,i1,1] = ky
+
+    else:
+        raise ValueError("The E-field alignment has to be 'M' or 'K'")
 
-    return np.array(mesh), np.array(paths)
+    return paths.reshape(Nk1*Nk2, 2), paths
 
-@njit
+@njit(cache=True, fastmath=True)
 def driving_field(E0, w, t, chirp, alpha, phase):
     '''
     Returns the instantaneous driving pulse field
@@ -463,7 +828,7 @@ def driving_field(E0, w, t, chirp, alpha, phase):
     # Chirped Gaussian pulse
     return E0*np.exp(-t**2.0/(2.0*alpha)**2)*np.sin(2.0*np.pi*w*t*(1 + chirp*t) + phase)
 
-@njit
+@njit(cache=True, fastmath=True)
 def rabi(k,E0,w,t,chirp,alpha,phase,dipole_in_path):
     '''
     Rabi frequency of the transition. Calculated from dipole element and driving field
@@ -479,9 +844,12 @@ def diff(x,y):
     elif len(y) == 1:
         return 0
     else:
-        dx = np.gradient(x)
-        dy = np.gradient(y)
-        return dy/dx
+        # Central differences inside, one-sided differences at the boundaries
+        dydx = np.empty_like(y)
+        dydx[1:-1] = (y[2:] - y[:-2])/(x[2:] - x[:-2])
+        dydx[0]    = (y[1] - y[0])/(x[1] - x[0])
+        dydx[-1]   = (y[-1] - y[-2])/(x[-1] - x[-2])
+        return dydx
 
 def Gaussian_envelope(t,alpha):
     '''
@@ -494,67 +862,33 @@ def polarization(paths,pcv,E_dir):
     '''
     Calculates the polarization as: P(t) = sum_n sum_m sum_k [d_nm(k)p_nm(k)]
     '''
-    E_ort = np.array([E_dir[1], -E_dir[0]])
-
-    d_E_dir, d_ortho = [],[]
-    for path in paths:
-
-        kx_in_path = path[:,0]
-        ky_in_path = path[:,1]
-
-        # Evaluate the dipole moments in path
-        di_x, di_y = 1.0, 1.0
-
-        # Append the dot product d.E
-        d_E_dir.append(di_x*E_dir[0] + di_y*E_dir[1])
-        d_ortho.append(di_x*E_ort[0] + di_y*E_ort[1])
-
-    P_E_dir = 2*np.real(np.dot(di_x,pcv))
-    P_ortho = 2*np.real(np.dot(di_y,pcv))
-
-    P_E_dir = np.sum(np.sum(P_E_dir,axis=0),axis=0)
-    P_ortho = np.sum(np.sum(P_ortho,axis=0),axis=0)
-    #P_E_dir = 2*np.real(np.tensordot(d_E_dir,pcv,2))
-    #P_ortho = 2*np.real(np.tensordot(d_ortho,pcv,2))
+    # The dipole moments are constant (1.0) in both directions, so both components are the sum
+    # of pcv over both k-indices of all paths
+    P_E_dir = 2*np.real(pcv.sum(axis=(0,1)))
+    P_ortho = P_E_dir.copy()
 
     return P_E_dir, P_ortho
 
-def current(paths,fv,fc,path,t,alpha,E_dir,delta0,delta1,a):
+def current(paths,fv,fc,t,alpha,E_dir,delta0,delta1,a):
     '''
     Calculates the current as: J(t) = sum_k sum_n [j_n(k)f_n(k,t)]
     where j_n(k) != (d/dk) E_n(k)
     '''
+    # k-points of all paths laid out as (k in path, path) like fc and fv
+    kx_in_paths = np.ascontiguousarray(paths[:,:,0].T)
+    ky_in_paths = np.ascontiguousarray(paths[:,:,1].T)
 
-    # Define the orthogonal E-field direction
-    E_ort = np.array([E_dir[1], -E_dir[0]])
+    # The band gradients are delta0*a*sin(k*a) (conduction) and -delta1*a*sin(k*a) (valence),
+    # so the k-dependence is evaluated once for each direction and shared by both bands
+    sin_kx = np.sin(kx_in_paths*a)
+    sin_ky = np.sin(ky_in_paths*a)
 
-    # Calculate the gradient analytically at each k-point
-    diffecx, diffecy, diffevx, diffevy = [], [], [], []
-    # Create arrays of derivatives for each direction and each band
-    for path in paths:
-        path = np.array(path)
-        kx_in_path = path[:,0]
-        ky_in_path = path[:,1]
-        diffecx.append(delta0*a*np.sin(kx_in_path*a))
-        diffecy.append(delta0*a*np.sin(ky_in_path*a))
-        diffevx.append(-delta1*a*np.sin(kx_in_path*a))
-        diffevy.append(-delta1*a*np.sin(ky_in_path*a))
-
-    # Swap the axes of the derivative arrays
-    diffecx = np.swapaxes(diffecx,0,1)
-    diffecy = np.swapaxes(diffecy,0,1)
-    diffevx = np.swapaxes(diffevx,0,1)
-    diffevy = np.swapaxes(diffevy,0,1)
+    # Sum over bands before contracting over k
+    f_weighted = a*(delta0*fc - delta1*fv)
 
     # Dot product of each component
-    jc_E_dir = np.tensordot(diffecx,fc,2)
-    jc_ortho = np.tensordot(diffecy,fc,2)
-    jv_E_dir = np.tensordot(diffevx,fv,2)
-    jv_ortho = np.tensordot(diffevy,fv,2)
-
-    # Sum over bands
-    J_E_dir = jc_E_dir + jv_E_dir
-    J_ortho = jc_ortho + jv_ortho
+    J_E_dir = np.einsum('kp,kpt->t', sin_kx, f_weighted)
+    J_ortho = np.einsum('kp,kpt->t', sin_ky, f_weighted)
 
     # Return the real part of each component
     return np.real(J_E_dir), np.real(J_ortho)
@@ -569,8 +903,6 @@ def current_Bcurv(paths,fv,fc,bite,path,t,alpha,E_dir,E0,w,phase,dipole):
 
     E_ort = np.array([E_dir[1], -E_dir[0]])
 
-    print("shape f =", np.shape(fc))
-
     # Calculate the gradient analytically at each k-point
     J_E_dir, J_ortho = [], []
 
@@ -587,10 +919,7 @@ def current_Bcurv(paths,fv,fc,bite,path,t,alpha,E_dir,E0,w,phase,dipole):
     for j_time, time in enumerate(t):
        je_E_dir,je_ortho,jh_E_dir,jh_ortho = [],[],[],[]
 
-       print("j_time =", j_time, "/", np.shape(fc[0,0,:]))
-
        for path in paths:
-           path = np.array(path)
            kx_in_path = path[:,0]
            ky_in_path = path[:,1]
 
@@ -601,32 +930,22 @@ def current_Bcurv(paths,fv,fc,bite,path,t,alpha,E_dir,E0,w,phase,dipole):
 
            curv_eval = curv.evaluate(kx_in_path, ky_in_path)
 
-           #print("shape curv_eval =", np.shape(curv_eval))
-
            # the cross product of Berry curvature and E-field points only in direction orthogonal to E
            cross_prod_ortho = E_field[j_time]*curv_eval
 
-           print("shape bandstruc_deriv =", np.shape(bandstruc_deriv))
-           print("shaoe cross_prod      =", np.shape(cross_prod_ortho))
-
            #0: v, x   1: v,y   2: c, x  3: c, y
            je_E_dir.append(bandstruc_deriv[2]*E_dir[0] + bandstruc_deriv[3]*E_dir[1])
            je_ortho.append(bandstruc_deriv[2]*E_ort[0] + bandstruc_deriv[3]*E_ort[1] + cross_prod_ortho[1,1,:])
            jh_E_dir.append(bandstruc_deriv[0]*E_dir[0] + bandstruc_deriv[1]*E_dir[1])
            jh_ortho.append(bandstruc_deriv[0]*E_ort[0] + bandstruc_deriv[1]*E_ort[1] + cross_prod_ortho[0,0,:])
 
-       je_E_dir_swapped = np.swapaxes(je_E_dir,0,1)
-       je_ortho_swapped = np.swapaxes(je_ortho,0,1)
-       jh_E_dir_swapped = np.swapaxes(jh_E_dir,0,1)
-       jh_ortho_swapped = np.swapaxes(jh_ortho,0,1)
-
-       # we need tensordot for contracting the first two indices (2 kpoint directions)
-       J_E_dir.append(np.tensordot(je_E_dir_swapped,fc[:,:,j_time],2) + np.tensordot(jh_E_dir_swapped,fv[:,:,j_time],2))
-       J_ortho.append(np.tensordot(je_ortho_swapped,fc[:,:,j_time],2) + np.tensordot(jh_ortho_swapped,fv[:,:,j_time],2))
-
-     # we need tensordot for contracting the first two indices (2 kpoint directions)
-     #J_E_dir = np.tensordot(je_E_dir_swapped,fc,2) + np.tensordot(jh_E_dir_swapped,fv,2)
-     #J_ortho = np.tensordot(je_ortho_swapped,fc,2) + np.tensordot(jh_ortho_swapped,fv,2)
+       # Stack the paths to (path, k) arrays and contract both k-indices (path and k in path)
+       je_E_dir = np.stack(je_E_dir)
+       je_ortho = np.stack(je_ortho)
+       jh_E_dir = np.stack(jh_E_dir)
+       jh_ortho = np.stack(jh_ortho)
+       J_E_dir.append(np.einsum('pk,kp->', je_E_dir, fc[:,:,j_time], optimize=True) + np.einsum('pk,kp->', jh_E_dir, fv[:,:,j_time], optimize=True))
+       J_ortho.append(np.einsum('pk,kp->', je_ortho, fc[:,:,j_time], optimize=True) + np.einsum('pk,kp->', jh_ortho, fv[:,:,j_time], optimize=True))
 
     # Return the real part of each component
     return np.real(J_E_dir), np.real(J_ortho)
@@ -638,54 +957,149 @@ def get_A_field(E0, w, t, alpha):
     w_eff = 4*np.pi*alpha*w
     return np.real(-alpha*E0*np.sqrt(np.pi)/2*np.exp(-w_eff**2/4)*(2+erf(t/2/alpha-1j*w_eff/2)-erf(-t/2/alpha-1j*w_eff/2)))
 
-def f(t, y, kpath, dk, gamma2, E0, w, chirp, alpha, phase, ecv_in_path, dipole_in_path, A_in_path):
-    return fnumba(t, y, kpath, dk, gamma2, E0, w, chirp, alpha, phase, ecv_in_path, dipole_in_path, A_in_path)
+@njit(fastmath=True)
+def fnumba(t, y, kpath, dk, E0, w, chirp, alpha, phase, h0_in_path, dipole_in_path, A_in_path, m_idx, n_idx):
 
-@njit
-def fnumba(t, y, kpath, dk, gamma2, E0, w, chirp, alpha, phase, ecv_in_path, dipole_in_path, A_in_path):
+    # Driving field at time t, the same for all k-points
+    E_t = driving_field(E0, w, t, chirp, alpha, phase)
 
     # x != y(t+dt)
-    x = np.empty(np.shape(y), dtype=np.dtype('complex'))
+    x = np.empty_like(y)
 
+    return fnumba_field(E_t, y, x, dk, h0_in_path, dipole_in_path, A_in_path, m_idx, n_idx)
+
+@njit(cache=True, fastmath=True, parallel=True)
+def fnumba_field(E_t, y, x, dk, h0_in_path, dipole_in_path, A_in_path, m_idx, n_idx):
+    '''
+    Right hand side of fnumba for a given value E_t of the driving field, written into x and returned.
+    Used directly by the fixed-step schemes which tabulate the field on their time grid and reuse x.
+    '''
     # Gradient term coefficient
-    D = driving_field(E0, w, t, chirp, alpha, phase)/(2*dk)
+    D = E_t/(2*dk)
+
+    # Rabi frequency: w_R = d_12(k).E(t)
+    # Rabi frequency conjugate
+    wr          = dipole_in_path*E_t
+    wr_c        = np.conj(wr)
+
+    # Rabi frequency: w_R = (d_11(k) - d_22(k))*E(t)
+    wr_d_diag   = A_in_path*E_t
+
+    # Each component is a contiguous block of Nk entries
+    # [0:Nk] = f_v, [Nk:2Nk] = p_vc, [2Nk:3Nk] = p_cv, [3Nk:4Nk] = f_c
+    # Each k-point only writes its own entries of the blocks, so the k-points are distributed over the threads
+    Nk = m_idx.shape[0]
+    for k in prange(Nk):
+        m = m_idx[k]
+        n = n_idx[k]
+
+        # The occupations are real, their right hand sides are evaluated in real arithmetic
+        f_v  = y[k].real
+        p_vc = y[Nk+k]
+        f_c  = y[3*Nk+k].real
+        # 2*Im(wr*p_vc) from the real and imaginary parts, without forming the complex product
+        df   = 2*(wr.real*p_vc.imag + wr.imag*p_vc.real)
+
+        # The gradient couples each component to the same component at the next (m) and previous (n) k-point
+        x_vc        = (h0_in_path[k] + 1j*wr_d_diag)*p_vc - 1j*wr_c*(f_v-f_c) + D*(y[Nk+m] - y[Nk+n])
+        x[k]        = df + D*(y[m].real - y[n].real)
+        x[Nk+k]     = x_vc
+        x[2*Nk+k]   = x_vc.conjugate()
+        x[3*Nk+k]   = -df + D*(y[3*Nk+m].real - y[3*Nk+n].real)
+
+    return x
+
+@njit(cache=True)
+def jac_numba(t, y, kpath, dk, E0, w, chirp, alpha, phase, h0_in_path, dipole_in_path, A_in_path, m_idx, n_idx):
+    '''
+    Analytic Jacobian of fnumba for the BDF solver. The imaginary parts in fnumba are
+    written with p_cv = conj(p_vc) and real occupations, e.g. 2*Im(wr*p_vc) = -1j*(wr*p_vc - wr_c*p_cv),
+    which makes the right hand side linear and holomorphic in y.
+    '''
+    J = np.zeros((y.size, y.size), dtype=np.dtype('complex'))
+
+    # Driving field at time t, the same for all k-points
+    E_t = driving_field(E0, w, t, chirp, alpha, phase)
+
+    # Gradient term coefficient
+    D = E_t/(2*dk)
 
-    # Update the solution vector
     Nk_path = kpath.shape[0]
     for k in range(Nk_path):
 
-        i = 4*k
-        if k == 0:
-            m = 4*(k+1)
-            n = 4*(Nk_path-1)
-        elif k == Nk_path-1:
-            m = 0
-            n = 4*(k-1)
-        else:
-            m = 4*(k+1)
-            n = 4*(k-1)
-
-        #Energy term eband(i,k) the energy of band i at point k
-        ecv = ecv_in_path[k]
+        m = m_idx[k]
+        n = n_idx[k]
 
-        # Rabi frequency: w_R = d_12(k).E(t)
-        # Rabi frequency conjugate
-        #wr          = dipole_in_path[k]*D
-        wr          = rabi(k, E0, w, t, chirp, alpha, phase, dipole_in_path)
+        wr          = dipole_in_path*E_t
         wr_c        = wr.conjugate()
+        wr_d_diag   = A_in_path*E_t
+        diag_pvc    = h0_in_path[k] + 1j*wr_d_diag
+
+        # Gradient term couples each component to the same component at the neighbouring k-points
+        for j in range(4):
+            J[j*Nk_path+k, j*Nk_path+m] += D
+            J[j*Nk_path+k, j*Nk_path+n] -= D
+
+        # Component blocks of the state vector: f_v, p_vc, p_cv, f_c
+        i_v, i_vc, i_cv, i_c = k, Nk_path+k, 2*Nk_path+k, 3*Nk_path+k
+        J[i_v, i_vc]   += -1j*wr
+        J[i_v, i_cv]   += 1j*wr_c
+        J[i_vc, i_v]   += -1j*wr_c
+        J[i_vc, i_vc]  += diag_pvc
+        J[i_vc, i_c]   += 1j*wr_c
+        J[i_cv, i_v]   += 1j*wr
+        J[i_cv, i_cv]  += diag_pvc.conjugate()
+        J[i_cv, i_c]   += -1j*wr
+        J[i_c, i_vc]   += 1j*wr
+        J[i_c, i_cv]   += -1j*wr_c
+
+    return J
+
+class BDF_init(BDF):
+    '''
+    scipy BDF solver with its whole array of backward differences initialized. scipy only sets the first
+    two rows, but the first step already subtracts the third one, so leftover memory in it (NaN or inf)
+    made numpy warn about invalid values. The result of that subtraction is overwritten before it is used.
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.D[2:] = 0
 
-        # Rabi frequency: w_R = (d_11(k) - d_22(k))*E(t)
-        #wr_d_diag   = A_in_path[k]*D
-        wr_d_diag   = rabi(k, E0, w, t, chirp, alpha, phase, A_in_path)
+def jac_sparse_parts(dk, h0_in_path, dipole_in_path, A_in_path, m_idx, n_idx):
+    '''
+    Sparse parts of the Jacobian of fnumba, J = J0 + E(t)*J1. Same entries as jac_numba,
+    every entry apart from the constant p_vc and p_cv diagonals is linear in the driving field.
+    '''
+    Nk = h0_in_path.size
+    k  = np.arange(Nk)
+    i_v, i_vc, i_cv, i_c = k, Nk+k, 2*Nk+k, 3*Nk+k
 
-        # Update each component of the solution vector
-        # i = f_v, i+1 = p_vc, i+2 = p_cv, i+3 = f_c
-        x[i]   = 2*(wr*y[i+1]).imag + D*(y[m] - y[n])
-        x[i+1] = ( -1j*ecv - gamma2 + 1j*wr_d_diag)*y[i+1] - 1j*wr_c*(y[i]-y[i+3]) + D*(y[m+1] - y[n+1])
-        x[i+2] = x[i+1].conjugate()
-        x[i+3] = -2*(wr*y[i+1]).imag + D*(y[m+3] - y[n+3])
+    J0 = sparse.diags(np.concatenate((np.zeros(Nk), h0_in_path, np.conj(h0_in_path), np.zeros(Nk)))).tocsr()
 
-    return x
+    # Coefficients of E(t)
+    wr        = np.full(Nk, dipole_in_path, dtype=np.complex128)
+    wr_c      = wr.conjugate()
+    wr_d_diag = np.full(Nk, A_in_path, dtype=np.complex128)
+    grad      = np.full(Nk, 1/(2*dk), dtype=np.complex128)
+
+    # Gradient term couples each component to the same component at the neighbouring k-points
+    rows = [j*Nk+k for j in range(4)] + [j*Nk+k for j in range(4)]
+    cols = [j*Nk+m_idx for j in range(4)] + [j*Nk+n_idx for j in range(4)]
+    vals = [grad]*4 + [-grad]*4
+
+    for row, col, val in ((i_v, i_vc, -1j*wr), (i_v, i_cv, 1j*wr_c),
+                          (i_vc, i_v, -1j*wr_c), (i_vc, i_vc, 1j*wr_d_diag), (i_vc, i_c, 1j*wr_c),
+                          (i_cv, i_v, 1j*wr), (i_cv, i_cv, -1j*wr_d_diag.conjugate()), (i_cv, i_c, -1j*wr),
+                          (i_c, i_vc, 1j*wr), (i_c, i_cv, -1j*wr_c)):
+        rows.append(row)
+        cols.append(col)
+        vals.append(val)
+
+    # Duplicate entries (only for very short paths) are summed by the conversion
+    J1 = sparse.coo_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+                           shape=(4*Nk, 4*Nk)).tocsr()
+
+    return J0, J1
 
 '''
 OUT OF DATE/NOT FUNCTIONAL! FOR FUTURE WORK ON MAGNETIC FIELD IMPLEMENTATION.
@@ -789,17 +1203,20 @@ def f_matrix(t, y, kgrid, Nk, dk, gamma2, E0, w, alpha):
     return svec
 
 def initial_condition(e_fermi,temperature,e_c):
-    knum = e_c.size
-    ones = np.ones(knum)
-    zeros = np.zeros(knum)
+    # The k-points are along the last axis of e_c, leading axes (e.g. several paths) are kept
+    knum = e_c.shape[-1]
 
+    # Written directly in the component-block layout of the state vector: f_v, p_vc, p_cv, f_c
+    y0 = np.zeros(e_c.shape[:-1] + (4*knum,), dtype=DTYPE_C)
+    y0[..., 0:knum] = 1.0
     if (temperature > 1e-5):
-        distrib = 1/(np.exp((e_c-e_fermi)/temperature)+1)
-        return np.array([ones, zeros, zeros, distrib]).flatten('F')
-    else:
-        return np.array([ones, zeros, zeros, zeros]).flatten('F')
+        y0[..., 3*knum:] = 1/(np.exp((e_c-e_fermi)/temperature)+1)
+    return y0
 
 def BZ_plot(kpnts,a,b1,b2,E_dir,paths):
+    import matplotlib.pyplot as pl
+    from matplotlib import patches
+    from matplotlib.collections import PatchCollection
 
     R = 4.0*np.pi/(np.sqrt(27)*a)
     r = 2.0*np.pi/(3*a)
@@ -807,13 +1224,10 @@ def BZ_plot(kpnts,a,b1,b2,E_dir,paths):
     BZ_fig = pl.figure(figsize=(10,10))
     ax = BZ_fig.add_subplot(111,aspect='equal')
 
-    ax.add_patch(patches.RegularPolygon((0,0),6,radius=R,orientation=np.pi/6,fill=False))
-    ax.add_patch(patches.RegularPolygon(b1,6,radius=R,orientation=np.pi/6,fill=False))
-    ax.add_patch(patches.RegularPolygon(-b1,6,radius=R,orientation=np.pi/6,fill=False))
-    ax.add_patch(patches.RegularPolygon(b2,6,radius=R,orientation=np.pi/6,fill=False))
-    ax.add_patch(patches.RegularPolygon(-b2,6,radius=R,orientation=np.pi/6,fill=False))
-    ax.add_patch(patches.RegularPolygon(b1+b2,6,radius=R,orientation=np.pi/6,fill=False))
-    ax.add_patch(patches.RegularPolygon(-b1-b2,6,radius=R,orientation=np.pi/6,fill=False))
+    # First Brillouin zone and its six neighbours, drawn as one collection
+    centers = [(0,0), b1, -b1, b2, -b2, b1+b2, -b1-b2]
+    ax.add_collection(PatchCollection([patches.RegularPolygon(c,6,radius=R,orientation=np.pi/6,fill=False)
+                                       for c in centers], match_original=True))
 
     ax.arrow(-0.5*E_dir[0],-0.5*E_dir[1],E_dir[0],E_dir[1],width=0.005,alpha=0.5,label='E-field')
 
@@ -830,7 +1244,6 @@ def BZ_plot(kpnts,a,b1,b2,E_dir,paths):
     pl.ylabel(r'$k_y$ ($1/a_0$)')
 
     for path in paths:
-        path = np.array(path)
         pl.plot(path[:,0],path[:,1])
 
     return
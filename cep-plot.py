@@ -57,13 +57,13 @@ I_ortho   = []
 Int_Edir  = []
 Int_ortho = []
 for i_phase, phase in enumerate(phases):
-    I_filename = str('I_Nk1-{}_Nk2-{}_w{:4.2f}_E{:4.2f}_a{:4.2f}_ph{:3.2f}_T2-{:05.2f}.npy').format(Nk1,Nk2,w,E0,alpha,phase,T2)
+    I_filename = str('I_Nk1-{}_Nk2-{}_w{:4.2f}_E{:4.2f}_a{:4.2f}_ph{:3.2f}_T2-{:05.2f}.npz').format(Nk1,Nk2,w,E0,alpha,phase,T2)
     I = np.load(I_filename)
-    freq  = I[3]
-    I_Edir.append(I[4])
-    I_ortho.append(I[5])
-    Int_Edir.append(I[6])
-    Int_ortho.append(I[7])
+    freq  = I['freq']
+    I_Edir.append(I['Iw_E_dir'])
+    I_ortho.append(I['Iw_ortho'])
+    Int_Edir.append(I['Int_E_dir'])
+    Int_ortho.append(I['Int_ortho'])
 I_Edir,I_ortho,Int_Edir,Int_ortho = np.array(I_Edir),np.array(I_ortho),np.array(Int_Edir),np.array(Int_ortho)
 
 cep_plot(freq, phases, Int_Edir+Int_ortho, xlims, r'Relative intensity')
@@ -93,3 +93,14 @@ fitted_pulse        = False
 KK_emission         = True
 normalize_emission  = False         
 normalize_f_valence = False
+n_proc              = 1      # Number of processes solving the k-paths in parallel, 0 uses one process per core
+solver_method       = 'bdf'  # 'bdf': scipy zvode BDF solver, 'adams': scipy zvode Adams solver without Jacobian (non-stiff cases),
+                             # 'rk45': compiled adaptive Dormand-Prince solver,
+                             # 'rk4': compiled fixed-step RK4 solver (SBE_SC.py only),
+                             # 'bdf_sparse': scipy BDF solver with a sparse analytic Jacobian (SBE.py: length gauge
+                             #               density matrix dynamics without B-field only, otherwise 'bdf' is used with a warning),
+                             # 'cuda': fixed-step RK4 of all paths on the GPU (needs numba.cuda, SBE_SC.py only)
+batch_paths         = False  # Set to True to propagate all paths in one state vector (meant for 'rk45', 'rk4' and 'bdf_sparse',
+                             # the dense Jacobian of 'bdf' grows with the square of the total number of k-points)
+single_precision    = False  # Set to True to store and propagate the density matrix in complex64 instead of complex128
+                             # (SBE.py only stores the path solutions in complex64 and propagates in complex128)
@@ -0,0 +1,140 @@
+import numpy as np
+import os, sys, warnings, pytest
+
+#######################################################################################################
+# THIS SCRIPT NEEDS TO BE EXECUTED IN THE MAIN GIT DIRECTORY BY CALLING python3 tests/test_solvers.py #
+#######################################################################################################
+
+# The CUDA kernels are checked on the CPU simulator of numba, it has to be enabled before numba is imported
+os.environ.setdefault('NUMBA_ENABLE_CUDASIM', '1')
+sys.path.insert(0, os.getcwd())
+
+import params
+import SBE_SC
+
+def path_args(t_window, solver_method):
+   '''
+   Arguments of SBE_SC.solve_path besides the path for the default 2line case of SBE_SC.main,
+   propagated from -t_window to t_window (in fs) around the maximum of the pulse.
+   '''
+   fs_conv = params.fs_conv
+   eV_conv = params.eV_conv
+
+   E_dir = np.array([np.cos(np.radians(params.angle_inc_E_field)),np.sin(np.radians(params.angle_inc_E_field))])
+   dk, kpnts, paths = SBE_SC.mesh(params, E_dir)
+
+   t0 = int(-t_window*fs_conv)
+   tf = int(t_window*fs_conv)
+   dt = params.dt*fs_conv
+   dt_out = max(1, int(round(1/(2*params.dt))))
+   Nt = int((tf-t0)/dt)
+   n_out = np.count_nonzero(np.arange(Nt)%dt_out == 0)
+
+   args = (t0, dt, Nt, dt_out, n_out, dk, 1/(params.T2*fs_conv), params.E0*params.E_conv, params.w*params.THz_conv,
+           params.chirp*params.THz_conv, params.alpha*fs_conv, params.phase, params.e_fermi*eV_conv,
+           params.temperature*eV_conv, params.a, 1.0*eV_conv, 6.9*eV_conv, False, solver_method)
+
+   return paths, args
+
+def solve_first_path(t_window, solver_method):
+   paths, args = path_args(t_window, solver_method)
+   return SBE_SC.solve_path(paths[0], 1, *args)
+
+def test_rk45_matches_bdf():
+   t_bdf, y_bdf = solve_first_path(100, 'bdf')
+   t_rk45, y_rk45 = solve_first_path(100, 'rk45')
+
+   assert np.allclose(t_rk45, t_bdf, rtol=1e-14, atol=0)
+   # Both solvers run at a relative tolerance of 1e-6, the polarizations are of the order of 1e-3
+   assert np.allclose(y_rk45, y_bdf, rtol=1e-4, atol=1e-5)
+
+def test_bdf_sparse_matches_bdf():
+   t_bdf, y_bdf = solve_first_path(100, 'bdf')
+   # The sparse BDF solver must not produce invalid values on the way
+   with warnings.catch_warnings():
+      warnings.simplefilter('error')
+      t_sparse, y_sparse = solve_first_path(100, 'bdf_sparse')
+
+   assert np.allclose(t_sparse, t_bdf, rtol=1e-14, atol=0)
+   assert np.allclose(y_sparse, y_bdf, rtol=1e-4, atol=1e-5)
+
+def test_worker_pool_matches_serial():
+   paths, args = path_args(20, 'bdf')
+   # The parallel kernels have already run in this process, the workers must not inherit its threads
+   serial = [SBE_SC.solve_path(path, i_path+1, *args) for i_path, path in enumerate(paths)]
+   pooled = SBE_SC.solve_paths_pool(paths, 2, *args)
+
+   for (t_serial, y_serial), (t_pool, y_pool) in zip(serial, pooled):
+      assert np.array_equal(t_pool, t_serial)
+      assert np.allclose(y_pool, y_serial, rtol=1e-12, atol=1e-15)
+
+def test_SBE_sparse_jacobian_matches_finite_differences():
+   # SBE.py sets up its model system with hfsbe on import
+   pytest.importorskip('hfsbe')
+   import SBE
+
+   rng = np.random.default_rng(0)
+   fs_conv = params.fs_conv
+
+   # Both paths of the 2line mesh in one state vector, with random band gaps and dipoles
+   E_dir = np.array([1.0, 0.0])
+   dk, kpnts, paths = SBE.mesh(params, E_dir)
+   Nk_path = np.size(paths, 1)
+   path = paths.reshape(-1, 2)
+   Nk = np.size(path, 0)
+   k_in_path = np.arange(Nk)
+   path_start = k_in_path - k_in_path % Nk_path
+   m_idx = 8*(path_start + (k_in_path+1) % Nk_path)
+   n_idx = 8*(path_start + (k_in_path-1) % Nk_path)
+
+   ecv_in_path = rng.uniform(0.05, 0.3, Nk)
+   dipole_in_path = rng.normal(size=Nk) + 1j*rng.normal(size=Nk)
+   Avv_in_path = rng.normal(size=Nk) + 0j
+   Acc_in_path = rng.normal(size=Nk) + 0j
+   A_in_path = Avv_in_path - Acc_in_path
+
+   gamma1 = 1/(params.T1*fs_conv)
+   gamma2 = 1/(params.T2*fs_conv)
+   E0 = 50*params.E0*params.E_conv
+   y0_np = np.zeros(8*Nk+1)
+   y0_np[0:8*Nk:8] = 1
+
+   f_params = (path, dk, gamma1, gamma2, E0, 0.0, 0.0, 0.0, 0.0, 0.0, False,
+               ecv_in_path, -ecv_in_path/2, ecv_in_path/2,
+               dipole_in_path, A_in_path, Avv_in_path, Acc_in_path,
+               'length', path[:,0].copy(), path[:,1].copy(), E_dir, y0_np, False,
+               'density_matrix_dynamics', m_idx, n_idx)
+
+   # State and direction with real occupations and p_cv = conj(p_vc), the Jacobian is written for them
+   def physical_vector():
+      v = np.zeros(8*Nk+1, dtype=np.complex128)
+      p_vc = rng.normal(size=Nk) + 1j*rng.normal(size=Nk)
+      v[0:8*Nk:8] = rng.uniform(size=Nk)
+      v[1:8*Nk:8] = p_vc
+      v[2:8*Nk:8] = p_vc.conjugate()
+      v[3:8*Nk:8] = rng.uniform(size=Nk)
+      v[-1] = rng.normal()
+      return v
+
+   y = physical_vector()
+   dy = physical_vector()
+
+   J0, J1 = SBE.jac_sparse_parts(dk, gamma1, gamma2, ecv_in_path, dipole_in_path, A_in_path, m_idx, n_idx)
+   for t in (-20*fs_conv, 3.0, 10*fs_conv):
+      J = J0 + SBE.driving_field(E0, t)*J1
+      eps = 1e-6
+      dx = (SBE.fnumba(t, y + eps*dy, *f_params) - SBE.fnumba(t, y, *f_params))/eps
+      assert np.allclose(dx, J @ dy, rtol=1e-7, atol=1e-9)
+
+def test_cuda_matches_rk4():
+   # The simulator runs every thread in Python, so only a short time window is propagated
+   paths, args = path_args(10, 'rk4')
+   t_cuda, y_cuda = SBE_SC.solve_paths_cuda(paths, *args[:-2])
+
+   for i_path, path in enumerate(paths):
+      t_rk4, y_rk4 = SBE_SC.solve_path(path, i_path+1, *args)
+      assert np.allclose(t_cuda, t_rk4, rtol=1e-14, atol=0)
+      assert np.allclose(y_cuda[i_path], y_rk4, rtol=1e-10, atol=1e-14)
+
+if __name__ == "__main__":
+   sys.exit(pytest.main([__file__]))